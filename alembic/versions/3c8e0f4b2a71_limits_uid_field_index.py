@@ -0,0 +1,19 @@
+"""Index limits by uid and field
+
+Revision ID: 3c8e0f4b2a71
+Revises: 51f3b3b5cd5d
+Create Date: 2026-10-18 10:12:31.508231
+
+"""
+# revision identifiers, used by Alembic.
+revision = '3c8e0f4b2a71'
+down_revision = '51f3b3b5cd5d'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_uid_field', 'limits', ['uid', 'field'])
+
+def downgrade():
+    op.drop_index('ix_uid_field', table_name='limits')
@@ -10,6 +10,9 @@ SOLR_SERVICE_SEARCH_HANDLER = SOLR_SERVICE_URL + '/select'
 SOLR_SERVICE_QTREE_HANDLER = SOLR_SERVICE_URL + '/qtree'
 SOLR_SERVICE_BIGQUERY_HANDLER = SOLR_SERVICE_URL + '/bigquery'
 SOLR_SERVICE_FORWARDED_COOKIES = set(['sroute'])
+SOLR_SERVICE_POOL_CONNECTIONS = False # keep-alive connections for requests that carry the forwarded cookies
+SOLR_SERVICE_POOL_MAX_SESSIONS = 128 # one per (handler url, cookie value)
+SOLR_SERVICE_POOL_MAXSIZE = 10 # connections per session
 SOLR_SERVICE_DEFAULT_FIELDS = ['id', 'recid', 'title', 'abstract', 'author', 'bibcode', 'identifier', 'volume', 'page', 'bibstem', 'doctype', 'pubdate', 'pub', 'pub_raw', 'citation_count', 'read_count', 'esources']
 SOLR_SERVICE_DISALLOWED_FIELDS = ['body', 'full', 'ack', 'readers', 'reader', 'email']
 SOLR_SERVICE_ALLOWED_FACET_FIELDS = ['bibstem_facet', 'author_facet_hier', 'property', 'keyword_facet', 'year', 'bibgroup_facet', 'data_facet', 'vizier_facet', 'grant_facet_hier', 'database', 'simbad_object_facet_hier', 'aff_facet_hier', 'doctype_facet_hier', 'first_author_facet_hier', 'ned_object_facet_hier',]
@@ -19,9 +22,43 @@ SOLR_SERVICE_ALLOWED_HIGHLIGHTS_FIELDS = ['title', 'abstract', 'keyword', 'autho
 SOLR_SERVICE_DISALLOWED_HIGHLIGHTS_PUBLISHERS = ['ieee']
 SOLR_SERVICE_ALLOWED_SORT_FIELDS = ['id asc', 'author_count asc', 'bibcode asc', 'citation_count asc', 'citation_count_norm asc', 'classic_factor asc', 'first_author asc', 'date asc', 'entry_date asc', 'read_count asc', 'score asc', 'id desc', 'author_count desc', 'bibcode desc', 'citation_count desc', 'citation_count_norm desc', 'classic_factor desc', 'first_author desc', 'date desc', 'entry_date desc', 'read_count desc', 'score desc',]
 #SOLR_SERVICE_TIME_ALLOWED_MS = 60000
+#SOLR_SERVICE_DEADLINE_MS = 65000 # budget for a whole request; defaults to SOLR_SERVICE_TIME_ALLOWED_MS + margin
+SOLR_SERVICE_DEADLINE_MARGIN_MS = 1000 # part of the budget not given to solr as timeAllowed (at most a quarter)
+SOLR_SERVICE_DEADLINE_HEADER = 'X-Request-Deadline-Ms' # clients may ask for a shorter budget
+SOLR_SERVICE_CONNECT_TIMEOUT = 3.05 # seconds
 SOLR_SERVICE_BOOST_TYPES = {'astrophysics': 'astronomy_final_boost', 'physics': 'physics_final_boost', 'earthscience': 'earth_science_final_boost', 'planetary': 'planetary_science_final_boost', 'heliophysics': 'heliophysics_final_boost', 'general': 'general_final_boost'}
 SOLR_SERVICE_MAX_ROWS = 2000
 SOLR_SERVICE_DEFAULT_ROWS = 10
+SOLR_SERVICE_STREAM_RESPONSES = False # relay solr responses chunk by chunk when they need no post-processing
+SOLR_SERVICE_STREAM_CHUNK_SIZE = 64 * 1024
+SOLR_SERVICE_STREAM_UPLOADS = False # send bigquery uploads to solr as a streamed multipart body
+SOLR_SERVICE_SPOOL_BYTES = 1024 * 1024 # larger uploads are spooled to a temporary file
+SOLR_SERVICE_INLINE_BIGQUERY_MAX_DOCS = 0 # smaller bigqueries become a {!terms f=bibcode} fq on /select (0: disabled)
+SOLR_SERVICE_BIGQUERY_STORE_BYTES = 0 # uploaded bigqueries kept for docs(sha:<hash>) (0: disabled)
+SOLR_SERVICE_BIGQUERY_STORE_MAX_ITEM_BYTES = 16 * 1024 * 1024
+SOLR_SERVICE_BIGQUERY_STORE_DIR = None # when set, they are also kept on local disk
+SOLR_SERVICE_BIGQUERY_STORE_DISK_BYTES = 1024 * 1024 * 1024
+SOLR_SERVICE_BIGQUERY_HASH_HEADER = 'X-Bigquery-Sha' # response header with the sha:<hash> of each upload
+SOLR_SERVICE_GZIP_UPLOADS = False # gzip the bigquery uploads sent to solr (needs a solr/jetty that inflates request bodies)
+SOLR_SERVICE_DECOMPRESS_REQUESTS = True # accept request bodies (and uploaded files) sent with Content-Encoding: gzip
+SOLR_SERVICE_MAX_DECOMPRESSED_BYTES = 256 * 1024 * 1024
+SOLR_SERVICE_RESULT_CACHE_BYTES = 0 # in-process cache of /query responses (0: disabled)
+#SOLR_SERVICE_RESULT_CACHE_TTL = 600 # defaults to max-age of SOLR_CACHE_CONTROL
+# seconds the rows of the limits table of a user are cached (0: disabled); changes
+# made by other processes are only seen once the entries expire
+SOLR_SERVICE_LIMITS_CACHE_TTL = 0
+SOLR_SERVICE_LIMITS_CACHE_USERS = 10000
+SOLR_SERVICE_VAULT_CACHE_BYTES = 0 # resolved docs(qid) streams kept in memory (0: disabled)
+SOLR_SERVICE_VAULT_CACHE_DIR = None # when set, they are also kept on local disk
+SOLR_SERVICE_VAULT_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+SOLR_SERVICE_COALESCE_REQUESTS = False # identical concurrent requests share one call to solr
+SOLR_SERVICE_COALESCE_TIMEOUT = 30 # seconds a duplicate waits before querying solr itself
+SOLR_SERVICE_ETAGS = True # send ETag with 200 responses and answer If-None-Match with 304
+SOLR_SERVICE_COMPRESSION = False # relay compressed solr responses as is, compress the ones we rewrite
+SOLR_SERVICE_COMPRESSION_MIN_BYTES = 1024
+SOLR_SERVICE_GZIP_LEVEL = 5
+SOLR_SERVICE_BROTLI_QUALITY = 4 # used when the (optional) brotli package is installed
+SOLR_SERVICE_JSON_CODEC = None # 'orjson', 'ujson' or 'json' to rewrite responses; None: fastest installed
 SOLR_INJECT_QUERY_PARAMS = dict()
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_DATABASE_URI = "sqlite:///"
@@ -42,6 +79,24 @@ ANONYMOUS_SOLR_SERVICE_URL = os.environ.get('ANONYMOUS_SOLR_SERVICE_URL', BOT_SO
 ANONYMOUS_SOLR_SERVICE_SEARCH_HANDLER = ANONYMOUS_SOLR_SERVICE_URL + '/select'
 ANONYMOUS_SOLR_SERVICE_BIGQUERY_HANDLER = ANONYMOUS_SOLR_SERVICE_URL + '/bigquery'
 BOT_TOKENS = []
+# Concurrency limits per handler class ('bot', 'anonymous', 'default'), e.g.
+# {'bot': {'limit': 4, 'queue': 8, 'timeout': 2, 'status': 503, 'retry_after': 5}}
+# at most `limit` requests run at once, `queue` more wait up to `timeout` seconds
+SOLR_SERVICE_BULKHEADS = {}
+# Circuit breaker per solr url (empty: disabled), e.g.
+# {'window': 20, 'min_calls': 10, 'failure_ratio': 0.5, 'slow_call_seconds': 10, 'reset_timeout': 30}
+SOLR_SERVICE_CIRCUIT_BREAKER = {}
+# Several solr instances behind one url (empty: urls are used as they are), e.g.
+# {SOLR_SERVICE_URL: [{'url': 'http://solr1:8983/solr', 'weight': 2}, 'http://solr2:8983/solr']}
+# requests with a route cookie go back to the instance that set it; instances failing their
+# ping, or with an open circuit breaker, get no traffic
+SOLR_SERVICE_BACKENDS = {}
+SOLR_SERVICE_BACKEND_PING = '/admin/ping'
+SOLR_SERVICE_BACKEND_PROBE_INTERVAL = 10 # seconds between pings (0: no active health checks)
+SOLR_SERVICE_BACKEND_PROBE_TIMEOUT = 2
+SOLR_SERVICE_BACKEND_ROUTES = 100000 # route cookies remembered with the instance that set them
+SOLR_SERVICE_BACKEND_EJECT_AFTER = 3 # failed calls in a row that take an instance out of rotation
+SOLR_SERVICE_BACKEND_EJECT_SECONDS = 30
 AFFINITY_ENHANCED_ENDPOINTS = {"/search": "sroute",} # keys: deploy paths, value: cookie
 SQLALCHEMY_BINDS = {'solr_service': "sqlite:///"}
 SQLALCHEMY_ECHO = False
@@ -51,3 +106,6 @@ SQLALCHEMY_RECORD_QUERIES = False
 API_URL = 'http://adsws'
 VAULT_ENDPOINT = API_URL + '/vault/query'
 LIBRARY_ENDPOINT = API_URL + '/biblib/libraries'
+SOLR_SERVICE_LIBRARY_WORKERS = 4 # pages of a library fetched concurrently
+SOLR_SERVICE_DOCS_WORKERS = 4 # docs() streams of one request resolved concurrently
+SOLR_SERVICE_LIBRARY_CACHE_BYTES = 0 # harvested libraries, revalidated against biblib on every use (0: disabled)
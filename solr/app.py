@@ -1,10 +1,25 @@
 from __future__ import absolute_import
+import gzip
+import hashlib
+from collections.abc import Iterator
 from past.builtins import basestring
-from flask import Flask, make_response, jsonify
+from flask import Flask, make_response, request
 from flask_restful import Api
 from flask_discoverer import Discoverer
 from flask_sqlalchemy import SQLAlchemy
 from .views import StatusView, Tvrh, Search, Qtree, BigQuery
+from .upstream import SessionPool, SingleFlight, Bulkhead, CircuitBreakers, Router
+from .cache import LRUCache, DiskCache, TieredCache
+from .jsonscan import first_member
+from .rules import SanitizationRules
+from . import codec
+from .middleware import DecompressRequestBody
+from .models import invalidate_on_write
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, responses are then compressed with gzip only
+    brotli = None
 from adsmutils import ADSFlask
 
 def create_app(**config):
@@ -37,6 +52,78 @@ def create_app(**config):
             # emit our own BEGIN
             conn.execute("BEGIN")
 
+    app.solr_rules = SanitizationRules.from_config(app.config)
+    app.solr_codec = codec.select(app.config.get('SOLR_SERVICE_JSON_CODEC'))
+
+    if app.config.get('SOLR_SERVICE_DECOMPRESS_REQUESTS', True):
+        app.wsgi_app = DecompressRequestBody(
+            app.wsgi_app, app.config.get('SOLR_SERVICE_MAX_DECOMPRESSED_BYTES', 256 * 1024 * 1024))
+
+    if app.config.get('SOLR_SERVICE_POOL_CONNECTIONS', False):
+        app.solr_sessions = SessionPool(
+            max_sessions=app.config.get('SOLR_SERVICE_POOL_MAX_SESSIONS', 128),
+            pool_maxsize=app.config.get('SOLR_SERVICE_POOL_MAXSIZE', 10),
+        )
+
+    if app.config.get('SOLR_SERVICE_RESULT_CACHE_BYTES', 0):
+        ttl = app.config.get('SOLR_SERVICE_RESULT_CACHE_TTL') or \
+            _max_age(app.config.get('SOLR_CACHE_CONTROL', "public, max-age=600"))
+        app.solr_result_cache = LRUCache(app.config['SOLR_SERVICE_RESULT_CACHE_BYTES'], ttl=ttl)
+
+    if app.config.get('SOLR_SERVICE_LIMITS_CACHE_TTL'):
+        # sized in number of users, every entry counts as 1
+        app.solr_limits_cache = LRUCache(app.config.get('SOLR_SERVICE_LIMITS_CACHE_USERS', 10000),
+                                         ttl=app.config['SOLR_SERVICE_LIMITS_CACHE_TTL'],
+                                         sizeof=lambda limits: 1)
+        invalidate_on_write(app.solr_limits_cache)
+
+    if app.config.get('SOLR_SERVICE_VAULT_CACHE_BYTES', 0):
+        # stored queries never change, so entries do not expire
+        app.solr_vault_cache = LRUCache(app.config['SOLR_SERVICE_VAULT_CACHE_BYTES'])
+        if app.config.get('SOLR_SERVICE_VAULT_CACHE_DIR'):
+            app.solr_vault_cache = TieredCache(
+                app.solr_vault_cache,
+                DiskCache(app.config['SOLR_SERVICE_VAULT_CACHE_DIR'],
+                          app.config.get('SOLR_SERVICE_VAULT_CACHE_DISK_BYTES', 1024 * 1024 * 1024)))
+
+    if app.config.get('SOLR_SERVICE_BIGQUERY_STORE_BYTES', 0):
+        # content addressed, entries never go stale
+        app.solr_bigquery_store = LRUCache(app.config['SOLR_SERVICE_BIGQUERY_STORE_BYTES'])
+        if app.config.get('SOLR_SERVICE_BIGQUERY_STORE_DIR'):
+            app.solr_bigquery_store = TieredCache(
+                app.solr_bigquery_store,
+                DiskCache(app.config['SOLR_SERVICE_BIGQUERY_STORE_DIR'],
+                          app.config.get('SOLR_SERVICE_BIGQUERY_STORE_DISK_BYTES', 1024 * 1024 * 1024)))
+
+    if app.config.get('SOLR_SERVICE_LIBRARY_CACHE_BYTES', 0):
+        app.solr_library_cache = LRUCache(app.config['SOLR_SERVICE_LIBRARY_CACHE_BYTES'])
+
+    if app.config.get('SOLR_SERVICE_COALESCE_REQUESTS', False):
+        app.solr_singleflight = SingleFlight()
+
+    app.solr_bulkheads = {}
+    for handler_class, settings in app.config.get('SOLR_SERVICE_BULKHEADS', {}).items():
+        app.solr_bulkheads[handler_class] = Bulkhead(
+            settings['limit'],
+            queue=settings.get('queue', 0),
+            timeout=settings.get('timeout'),
+        )
+
+    if app.config.get('SOLR_SERVICE_CIRCUIT_BREAKER'):
+        app.solr_breakers = CircuitBreakers(**app.config['SOLR_SERVICE_CIRCUIT_BREAKER'])
+
+    if app.config.get('SOLR_SERVICE_BACKENDS'):
+        app.solr_router = Router(
+            app.config['SOLR_SERVICE_BACKENDS'],
+            breakers=getattr(app, 'solr_breakers', None),
+            ping_path=app.config.get('SOLR_SERVICE_BACKEND_PING', '/admin/ping'),
+            probe_timeout=app.config.get('SOLR_SERVICE_BACKEND_PROBE_TIMEOUT', 2),
+            max_routes=app.config.get('SOLR_SERVICE_BACKEND_ROUTES', 100000),
+            eject_after=app.config.get('SOLR_SERVICE_BACKEND_EJECT_AFTER', 3),
+            eject_seconds=app.config.get('SOLR_SERVICE_BACKEND_EJECT_SECONDS', 30),
+        )
+        if app.config.get('SOLR_SERVICE_BACKEND_PROBE_INTERVAL', 10):
+            app.solr_router.start(app.config.get('SOLR_SERVICE_BACKEND_PROBE_INTERVAL', 10))
 
     api = Api(app)
 
@@ -47,9 +134,11 @@ def create_app(**config):
         return JSON as text string directly, without parsing and serializing
         it multiple times
         """
-        if not isinstance(data, basestring):
-            resp = jsonify(data)
-            resp.status_code = code
+        if isinstance(data, Iterator):
+            # chunks relayed from solr as they arrive (SolrInterface.stream_response)
+            resp = app.response_class(data, status=code)
+        elif not isinstance(data, basestring):
+            resp = make_response(app.solr_codec.dumps(data), code)
         else:
             resp = make_response(data, code)
         resp.headers['Content-Type'] = 'application/json'
@@ -58,8 +147,29 @@ def create_app(**config):
         )
         if code == 200:
             resp.headers['Cache-Control'] = app.config.get('SOLR_CACHE_CONTROL', "public, max-age=600")
-        if 'Set-Cookie' in headers:
-            resp.headers['Set-Cookie'] = headers['Set-Cookie']
+        for header in ('Set-Cookie', 'Retry-After'):
+            # solr may set several cookies (see views._clean_headers)
+            values = headers.getlist(header) if hasattr(headers, 'getlist') else \
+                [headers[header]] if header in headers else []
+            for value in values:
+                resp.headers.add(header, value)
+
+        # body relayed from solr still compressed (SolrInterface.encoded_response)
+        encoding = headers.get('Content-Encoding') if headers else None
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+        compression = app.config.get('SOLR_SERVICE_COMPRESSION', False)
+        if compression:
+            resp.vary.add('Accept-Encoding')
+
+        if resp.is_streamed or encoding:
+            return resp
+        if code == 200 and app.config.get('SOLR_SERVICE_ETAGS', True):
+            resp.set_etag(_etag(resp.get_data()), weak=True)
+        if compression:
+            _compress(resp, app.config)
+        if resp.get_etag()[0]:
+            resp.make_conditional(request) # bodiless 304 when If-None-Match matches
         return resp
 
     api.add_resource(StatusView, '/status')
@@ -72,6 +182,63 @@ def create_app(**config):
     return app
 
 
+def _max_age(cache_control):
+    """Extracts max-age (in seconds) from a Cache-Control value"""
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return 0
+
+
+def _etag(body):
+    """
+    Digest of a response body. Solr echoes the request parameters (with
+    the per-request trace id) and QTime in the responseHeader, so it is
+    left out: identical results get the same tag, which is why the tag
+    is used as a weak validator
+
+    :param body: bytes
+    :return: string
+    """
+    digest = hashlib.sha1()
+    try:
+        member = first_member(body)
+    except (ValueError, IndexError):
+        member = None
+    if member and member[0] == b'responseHeader':
+        digest.update(body[:member[1]])
+        digest.update(body[member[2]:])
+    else:
+        digest.update(body)
+    return digest.hexdigest()
+
+
+def _compress(resp, config):
+    """
+    Compresses the body of the response with the best content-encoding
+    the client accepts (brotli if it is installed, or gzip)
+
+    :param resp: flask.Response, not streamed
+    :param config: app.config
+    """
+    data = resp.get_data()
+    if len(data) < config.get('SOLR_SERVICE_COMPRESSION_MIN_BYTES', 1024):
+        return
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding == 'br':
+        data = brotli.compress(data, quality=config.get('SOLR_SERVICE_BROTLI_QUALITY', 4))
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=config.get('SOLR_SERVICE_GZIP_LEVEL', 5), mtime=0)
+    else:
+        return
+    resp.set_data(data)
+    resp.headers['Content-Encoding'] = encoding
+
 
 if __name__ == "__main__":
     app = create_app()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.cache
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Small in-process caches
+"""
+from __future__ import absolute_import
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache, bounded by the total size of
+    the stored values rather than by the number of entries. Entries can
+    also expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_bytes, ttl=None, sizeof=len):
+        """
+        :param max_bytes: int, upper bound for the sum of value sizes
+        :param ttl: float, seconds an entry stays valid (None: forever)
+        :param sizeof: callable, returns the size of a value
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data = OrderedDict() # key -> (value, size, expires)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, size, expires = item
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, size=None, ttl=None):
+        """
+        Stores the value; values larger than the whole cache are ignored
+
+        :return: bool, True if the value was stored
+        """
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expires)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        value, size, _ = self._data.pop(key)
+        self.nbytes -= size
+        return value
+
+
+class DiskCache(object):
+    """
+    Values (bytes) stored as files in a local directory, one file per
+    key; the least recently written files are removed once the directory
+    holds more than `max_bytes`. Meant for immutable values, entries
+    never expire. Safe to share between the processes of one host.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: string, created if it does not exist
+        :param max_bytes: int, upper bound for the sum of file sizes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = None # unknown until the directory is scanned
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return default
+
+    def set(self, key, value, size=None, ttl=None):
+        """
+        Stores the value atomically (readers never see partial files)
+
+        :return: bool, True if the value was stored
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return False
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, self._path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        with self._lock:
+            if self.nbytes is not None:
+                self.nbytes += size
+            if self.nbytes is None or self.nbytes > self.max_bytes:
+                self._shrink()
+        return True
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+        return value
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf8')).hexdigest())
+
+    def _shrink(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        files.sort()
+        total = sum(f[1] for f in files)
+        for _, size, name in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+        self.nbytes = total
+
+
+class TieredCache(object):
+    """
+    An in-memory LRUCache in front of a DiskCache: values found on disk
+    are promoted to memory, new values are written to both
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None:
+            value = self.disk.get(key)
+            if value is None:
+                return default
+            self.memory.set(key, value)
+        return value
+
+    def set(self, key, value, size=None, ttl=None):
+        stored = self.memory.set(key, value, size=size, ttl=ttl)
+        return self.disk.set(key, value) or stored
+
+    def pop(self, key, default=None):
+        value = self.memory.pop(key)
+        disk_value = self.disk.pop(key)
+        if value is None:
+            value = disk_value
+        return default if value is None else value
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.codec
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    JSON encoding and decoding of the responses we have to rewrite, with
+    the fastest library available
+"""
+from __future__ import absolute_import
+
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    # ujson is optional
+    ujson = None
+
+
+class JsonCodec(namedtuple('JsonCodec', ['name', 'loads', 'dumps'])):
+    """
+    `loads` accepts bytes or str, `dumps` always returns UTF-8 bytes so
+    that the body can be sent as it is
+    """
+    __slots__ = ()
+
+
+def _lenient(loads):
+    # solr may write NaN/Infinity (e.g. stats over no values) and the fast
+    # libraries refuse those, as well as integers over 64 bits
+    def wrapper(data):
+        try:
+            return loads(data)
+        except ValueError:
+            return json.loads(data)
+    return wrapper
+
+
+def _orjson():
+    return JsonCodec('orjson', _lenient(orjson.loads), orjson.dumps)
+
+
+def _ujson():
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+    return JsonCodec('ujson', _lenient(ujson.loads), dumps)
+
+
+def _stdlib():
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    return JsonCodec('json', json.loads, dumps)
+
+
+_CODECS = (('orjson', lambda: orjson is not None, _orjson),
+           ('ujson', lambda: ujson is not None, _ujson),
+           ('json', lambda: True, _stdlib))
+
+
+def select(name=None):
+    """
+    :param name: string, 'orjson', 'ujson' or 'json'; None picks the
+        first one installed, in that order
+    :return: JsonCodec
+    :raise ValueError: if the requested library is unknown or missing
+    """
+    for codec_name, available, factory in _CODECS:
+        if name in (None, codec_name):
+            if available():
+                return factory()
+            if name is not None:
+                raise ValueError('JSON library {} is not installed'.format(name))
+    raise ValueError('Unknown JSON library {}'.format(name))
+
+
+def available():
+    """:return: list of the names of the codecs that can be used"""
+    return [name for name, is_available, _ in _CODECS if is_available()]
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.highlight
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Post-processing of the highlights returned by solr
+"""
+from __future__ import absolute_import
+
+import re
+from typing import List
+
+from .jsonscan import decode_last_member, find_member
+
+_EMPHASIS = re.compile(r'<em>[^>]*</em>', re.IGNORECASE)
+
+# fields never highlighted for documents of some publishers
+# (SOLR_SERVICE_DISALLOWED_HIGHLIGHTS_PUBLISHERS)
+RESTRICTED_FIELDS = frozenset(['body', 'ack'])
+
+
+def postprocess(response_data, max_len, disallowed_publishers=frozenset()):
+    """
+    Drops the restricted highlights of documents from disallowed
+    publishers and cuts every highlight down to windows of `max_len`
+    characters around its emphasized terms; each document is visited
+    once.
+
+    :param response_data: dict, decoded solr response; modified in place
+    :param max_len: int, size of a window
+    :param disallowed_publishers: set of lowercase publisher names
+    :return: response_data
+    """
+    highlighting = response_data.get('highlighting') or {}
+    restricted = set()
+    if disallowed_publishers and _has_restricted_fields(highlighting):
+        restricted = _restricted_ids(response_data, disallowed_publishers)
+    _window_all(highlighting, max_len, restricted)
+    return response_data
+
+
+def rewrite(body, max_len, disallowed_publishers, codec):
+    """
+    Same as postprocess, on the serialized response: only the highlighting
+    section is decoded and encoded again, the bytes of every other member
+    are copied as they are. The members that precede it (i.e. the
+    documents) are only decoded when some publishers are disallowed and
+    restricted fields were highlighted.
+
+    :param body: bytes, solr response
+    :param codec: solr.codec.JsonCodec
+    :return: bytes, the response with `filtered` set
+    """
+    # solr writes the highlights after the documents and facets
+    found = decode_last_member(body, b'highlighting', codec.loads)
+    if found is not None:
+        separator, start, end, highlighting = found
+    else:
+        found = find_member(body, b'highlighting')
+        if found is None:
+            return _rewrite_decoded(body, max_len, disallowed_publishers, codec)
+        separator, start, end = found
+        highlighting = codec.loads(body[start:end])
+    restricted = set()
+    if disallowed_publishers and _has_restricted_fields(highlighting):
+        if body[separator:separator + 1] == b',':
+            preceding = codec.loads(body[:separator] + b'}')
+        else:
+            preceding = {}
+        if 'response' not in preceding:
+            # solr writes the documents first, anything else is unexpected
+            return _rewrite_decoded(body, max_len, disallowed_publishers, codec)
+        restricted = _restricted_ids(preceding, disallowed_publishers)
+    _window_all(highlighting, max_len, restricted)
+
+    close = body.rindex(b'}')
+    return b''.join((body[:start], codec.dumps(highlighting), body[end:close].rstrip(),
+                     b',"filtered":"true"', body[close:]))
+
+
+def window(text: str, max_len: int) -> List[str]:
+    """
+    Windows of `max_len` characters centered on each emphasized term
+    (terms longer than that are dropped); windows that overlap are
+    merged as long as the result is not longer than `max_len`, otherwise
+    the next window starts where the previous one ended, so no part of
+    the text is returned twice
+
+    :param text: string, a highlight returned by solr
+    :param max_len: int, size of a window
+    :return: list of strings
+    """
+    out = []
+    lo = hi = None
+    for match in _EMPHASIS.finditer(text):
+        term_start, term_end = match.span()
+        if term_end - term_start >= max_len:
+            continue
+        diff = (max_len - (term_end - term_start)) // 2
+        # a window cut by the start of the text extends further right
+        start = term_start - diff
+        end = term_end + diff - min(0, start)
+        start, end = max(0, start), min(len(text), end)
+        if hi is not None and start <= hi:
+            if max(hi, end) - lo <= max_len:
+                hi = max(hi, end)
+                continue
+            if term_end <= hi:
+                # already shown in full
+                continue
+            # only the part of the term that was cut off is repeated
+            start = min(hi, term_start)
+        if hi is not None:
+            out.append(text[lo:hi])
+        lo, hi = start, end
+    if hi is not None:
+        out.append(text[lo:hi])
+    return out
+
+
+def _rewrite_decoded(body, max_len, disallowed_publishers, codec):
+    response_data = postprocess(codec.loads(body), max_len, disallowed_publishers)
+    response_data['filtered'] = 'true'
+    return codec.dumps(response_data)
+
+
+def _has_restricted_fields(highlighting):
+    return any(not RESTRICTED_FIELDS.isdisjoint(fields) for fields in highlighting.values())
+
+
+def _restricted_ids(response_data, disallowed_publishers):
+    """:return: set, ids of the documents from disallowed publishers"""
+    return set(doc.get('id') for doc in response_data.get('response', {}).get('docs', [])
+               if _is_disallowed(doc.get('publisher'), disallowed_publishers))
+
+
+def _window_all(highlighting, max_len, restricted):
+    for doc_id, doc_highlights in highlighting.items():
+        skip = RESTRICTED_FIELDS if doc_id in restricted else ()
+        highlighting[doc_id] = {
+            field: [w for text in highlights if text for w in window(text, max_len)]
+            for field, highlights in doc_highlights.items()
+            if field not in skip
+        }
+
+
+def _is_disallowed(publisher, disallowed_publishers):
+    if isinstance(publisher, list):
+        return any(p.lower() in disallowed_publishers for p in publisher)
+    return publisher is not None and publisher.lower() in disallowed_publishers
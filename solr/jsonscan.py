@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.jsonscan
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Structural scanning of serialized JSON: finds where values start and
+    end without decoding them
+"""
+from __future__ import absolute_import
+
+import re
+
+_WHITESPACE = re.compile(br'[ \t\n\r]*')
+_STRING = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(br'[^,:\]}\s]+')
+# everything up to the next bracket, strings included so that brackets
+# inside them are never counted (unrolled, no per-character alternation)
+_FILLER = re.compile(br'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.DOTALL)
+
+_QUOTE, _OPEN_OBJECT, _OPEN_ARRAY = ord('"'), ord('{'), ord('[')
+_CLOSE_OBJECT, _CLOSE_ARRAY = ord('}'), ord(']')
+_SPACES = frozenset(b' \t\n\r')
+
+
+def skip_whitespace(buf, pos):
+    return _WHITESPACE.match(buf, pos).end()
+
+
+def value_end(buf, pos):
+    """
+    :param buf: bytes, serialized JSON
+    :param pos: int, index where a value starts (whitespace is skipped)
+    :return: int, index just past the end of that value
+    """
+    pos = skip_whitespace(buf, pos)
+    first = buf[pos]
+    if first == _QUOTE:
+        m = _STRING.match(buf, pos)
+    elif first == _OPEN_OBJECT or first == _OPEN_ARRAY:
+        depth = 0
+        filler = _FILLER.match
+        try:
+            while True:
+                c = buf[pos]
+                if c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                    depth += 1
+                elif c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                    depth -= 1
+                    if depth == 0:
+                        return pos + 1
+                else:
+                    # the filler only stops short of a bracket at an
+                    # unterminated string
+                    break
+                pos = filler(buf, pos + 1).end()
+        except IndexError:
+            pass
+        m = None
+    else:
+        m = _SCALAR.match(buf, pos)
+    if m is None:
+        raise ValueError('Malformed JSON value at offset {}'.format(pos))
+    return m.end()
+
+
+def first_member(buf):
+    """
+    Locates the first member of a serialized JSON object
+
+    :param buf: bytes
+    :return: tuple - (key as bytes, value start, value end) or None if
+        buf is not a non-empty object
+    """
+    pos = skip_whitespace(buf, 0)
+    if buf[pos:pos + 1] != b'{':
+        return None
+    pos = skip_whitespace(buf, pos + 1)
+    m = _STRING.match(buf, pos)
+    if m is None:
+        return None
+    pos = skip_whitespace(buf, m.end())
+    if buf[pos:pos + 1] != b':':
+        return None
+    start = skip_whitespace(buf, pos + 1)
+    return buf[m.start() + 1:m.end() - 1], start, value_end(buf, start)
+
+
+def find_member(buf, key):
+    """
+    Locates a member of the top level object without walking the values
+    that precede it: the last occurrence of the key is taken and only the
+    members that follow it are walked, to make sure it is not nested
+
+    :param buf: bytes, serialized JSON object
+    :param key: bytes, name of the member (as serialized)
+    :return: tuple - (start of the member, including the separator that
+        precedes it, value start, value end) or None if not found
+    """
+    needle = b'"' + key + b'"'
+    end = _last_non_space(buf, len(buf))
+    if end < 0 or buf[end] != _CLOSE_OBJECT:
+        return None
+    pos = buf.rfind(needle)
+    while pos > 0:
+        separator = _last_non_space(buf, pos)
+        if buf[separator:separator + 1] in (b',', b'{'):
+            try:
+                span = _member_value(buf, pos)
+                if span is not None and _closes_object(buf, span[1], end):
+                    return separator, span[0], span[1]
+            except (ValueError, IndexError):
+                pass
+        pos = buf.rfind(needle, 0, pos)
+    return None
+
+
+def decode_last_member(buf, key, decode):
+    """
+    Decodes the last member of a serialized JSON object if it is named
+    `key`, without walking its value: whatever lies between the key and
+    the closing bracket of the object must decode as a single value
+    (which also rules out a key of a nested object)
+
+    :param buf: bytes, serialized JSON object
+    :param key: bytes, name of the member (as serialized)
+    :param decode: callable, bytes -> decoded value; raises ValueError
+    :return: tuple - (start of the member, including the separator that
+        precedes it, value start, value end, decoded value) or None
+    """
+    end = _last_non_space(buf, len(buf))
+    pos = buf.rfind(b'"' + key + b'"', 0, max(end, 0))
+    if end < 0 or buf[end] != _CLOSE_OBJECT or pos < 0:
+        return None
+    separator = _last_non_space(buf, pos)
+    if buf[separator:separator + 1] not in (b',', b'{'):
+        return None
+    m = _STRING.match(buf, pos)
+    pos = skip_whitespace(buf, m.end())
+    if buf[pos:pos + 1] != b':':
+        return None
+    start = skip_whitespace(buf, pos + 1)
+    value_stop = _last_non_space(buf, end) + 1
+    try:
+        return separator, start, value_stop, decode(buf[start:value_stop])
+    except ValueError:
+        return None
+
+
+def _last_non_space(buf, pos):
+    pos -= 1
+    while pos >= 0 and buf[pos] in _SPACES:
+        pos -= 1
+    return pos
+
+
+def _member_value(buf, pos):
+    """:return: tuple - (value start, value end) of the member at pos"""
+    m = _STRING.match(buf, pos)
+    if m is None:
+        return None
+    pos = skip_whitespace(buf, m.end())
+    if buf[pos:pos + 1] != b':':
+        return None
+    start = skip_whitespace(buf, pos + 1)
+    return start, value_end(buf, start)
+
+
+def _closes_object(buf, pos, end):
+    """:return: bool, the members from pos on close the object at end"""
+    while True:
+        pos = skip_whitespace(buf, pos)
+        if pos == end:
+            return True
+        if buf[pos:pos + 1] != b',':
+            return False
+        span = _member_value(buf, skip_whitespace(buf, pos + 1))
+        if span is None:
+            return False
+        pos = span[1]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.middleware
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    WSGI middleware applied by create_app
+"""
+from __future__ import absolute_import
+
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+_GZIP_ENCODINGS = frozenset(['gzip', 'x-gzip'])
+
+
+class DecompressRequestBody(object):
+    """
+    Accepts request bodies sent with `Content-Encoding: gzip`: the body
+    is inflated while the application reads it, so the views (and the
+    werkzeug form parser) see the plain body and nothing is decompressed
+    up front. The inflated size is capped to protect against
+    decompression bombs.
+    """
+
+    def __init__(self, wsgi_app, max_bytes):
+        """
+        :param wsgi_app: the wrapped WSGI application
+        :param max_bytes: int, largest accepted inflated body
+        """
+        self.wsgi_app = wsgi_app
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in _GZIP_ENCODINGS:
+            environ['wsgi.input'] = GzipInput(environ['wsgi.input'], self.max_bytes,
+                                              _safe_length(environ.get('CONTENT_LENGTH')))
+            # the length of the inflated body is unknown, the stream ends
+            # where the gzip data ends
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+class GzipInput(object):
+    """
+    File-like that inflates a gzip stream as it is read; raises
+    BadRequest when the stream is malformed or truncated
+    """
+
+    def __init__(self, stream, max_bytes, length=None, chunk_size=64 * 1024):
+        """
+        :param stream: file-like, the compressed data
+        :param max_bytes: int, largest inflated size that may be read
+        :param length: int, compressed bytes to read from stream (None:
+            until it is exhausted)
+        """
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.total = 0
+        self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._eof = False
+        self._in_member = False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            out, self._buffer = self._buffer, b''
+        else:
+            out, self._buffer = self._buffer[:size], self._buffer[size:]
+        return out
+
+    def readline(self, size=-1):
+        while not self._eof and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        out, self._buffer = self._buffer[:end], self._buffer[end:]
+        return out
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+    def _fill(self):
+        want = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+        data = self.stream.read(want) if want else b''
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        if not data:
+            if self._in_member:
+                raise BadRequest('Malformed gzip body: the data is truncated')
+            self._eof = True
+            return
+        try:
+            # a body may hold several gzip members, one after the other
+            while data:
+                self._in_member = True
+                # never inflate more than one byte past the limit at a time
+                chunk = self._inflate.decompress(data, self.max_bytes - self.total + 1)
+                while self._inflate.unconsumed_tail and len(chunk) <= self.max_bytes - self.total:
+                    chunk += self._inflate.decompress(self._inflate.unconsumed_tail,
+                                                      self.max_bytes - self.total - len(chunk) + 1)
+                self.total += len(chunk)
+                if self.total > self.max_bytes:
+                    raise RequestEntityTooLarge('The decompressed body exceeds {} bytes'.format(self.max_bytes))
+                self._buffer += chunk
+                data = b''
+                if self._inflate.eof:
+                    self._in_member = False
+                    data = self._inflate.unused_data
+                    self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise BadRequest('Malformed gzip body: {}'.format(e))
+
+
+def _safe_length(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
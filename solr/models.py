@@ -5,8 +5,12 @@
 
     Models for the users (users) of AdsWS
 """
-from sqlalchemy import Column, Integer, String, Text
+import itertools
+import weakref
+
+from sqlalchemy import Column, Index, Integer, String, Text, event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
 
 
 Base = declarative_base()
@@ -14,6 +18,7 @@ Base = declarative_base()
 
 class Limits(Base):
     __tablename__ = 'limits'
+    __table_args__ = (Index('ix_uid_field', 'uid', 'field'),)
     id = Column(Integer, primary_key=True)
     uid = Column(String(255))
     field = Column(String(255))
@@ -26,3 +31,27 @@ class Limits(Base):
             'field': self.field,
             'filter': self.filter or None
         }
+
+
+# caches of the limits table kept by this process; see invalidate_on_write
+_limits_caches = weakref.WeakSet()
+
+
+def invalidate_on_write(cache):
+    """
+    Clears `cache` whenever a session of this process flushes changes
+    to the limits table. Rows modified by other processes (or with bulk
+    query.update/delete) are only seen once the cached entries expire.
+
+    :param cache: object with a clear() method
+    """
+    _limits_caches.add(cache)
+
+
+@event.listens_for(Session, 'after_flush')
+def _limits_flushed(session, flush_context):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if getattr(obj, '__tablename__', None) == Limits.__tablename__:
+            for cache in list(_limits_caches):
+                cache.clear()
+            return
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.multipart
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Streaming multipart/form-data bodies for the bigquery uploads
+"""
+from __future__ import absolute_import
+
+import binascii
+import gzip
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+# fields that werkzeug parses (and spools) itself
+FORM_MIMETYPES = frozenset(['multipart/form-data', 'application/x-www-form-urlencoded'])
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def spool(stream, max_size, chunk_size=_CHUNK_SIZE):
+    """
+    Copies a stream chunk by chunk into a temporary file that is only
+    written to disk once it grows over `max_size` bytes
+
+    :param stream: file-like, read until exhausted
+    :return: file-like positioned at 0, or None if the stream was empty
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=max_size)
+    shutil.copyfileobj(stream, out, chunk_size)
+    if out.tell() == 0:
+        out.close()
+        return None
+    out.seek(0)
+    return out
+
+
+def gzip_spool(stream, max_size, level=5, chunk_size=_CHUNK_SIZE):
+    """
+    Compresses a stream chunk by chunk into a spooled temporary file
+
+    :param stream: file-like, read until exhausted
+    :return: SizedStream with the gzip data
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=max_size)
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0) as gz:
+        shutil.copyfileobj(stream, gz, chunk_size)
+    length = out.tell()
+    out.seek(0)
+    return SizedStream(out, length)
+
+
+class SizedStream(object):
+    """
+    A file-like of known length; requests sends it with a Content-Length
+    without probing the underlying file (a SpooledTemporaryFile would be
+    rolled over to disk when asked for its fileno)
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+
+
+class MultipartEncoder(object):
+    """
+    The multipart/form-data body that requests would build for `files=`,
+    produced while it is being sent: requests (and http.client) read it
+    in blocks, so the uploaded documents are never copied into one big
+    bytes object. Its length is known up front and sent as Content-Length.
+    """
+
+    def __init__(self, files, boundary=None, spool_size=1024 * 1024):
+        """
+        :param files: dict, name -> (filename, data, content type) where
+            data is str, bytes or a file-like object
+        :param boundary: string, generated when not given
+        :param spool_size: int, in-memory limit used when a non-seekable
+            file-like has to be buffered to find out its length
+        """
+        self.boundary = boundary or binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self._parts = []
+        for name, value in files.items():
+            filename, data, ctype = (tuple(value) + (None, None))[:3]
+            if data is None:
+                continue
+            header = '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'.format(
+                self.boundary, _quote(name), _quote(filename or name))
+            if ctype:
+                header += 'Content-Type: {}\r\n'.format(ctype)
+            self._parts.append(BytesIO((header + '\r\n').encode('utf-8')))
+            self._parts.append(_as_stream(data, spool_size))
+            self._parts.append(BytesIO(b'\r\n'))
+        self._parts.append(BytesIO('--{}--\r\n'.format(self.boundary).encode('utf-8')))
+        self._len = sum(_remaining(p) for p in self._parts)
+        self._current = 0
+
+    def __len__(self):
+        return self._len
+
+    def read(self, size=-1):
+        """
+        :param size: int, bytes wanted (-1: everything that is left)
+        :return: bytes, empty once the body was read completely
+        """
+        out = []
+        while self._current < len(self._parts) and size != 0:
+            chunk = self._parts[self._current].read(size)
+            if not chunk:
+                self._current += 1
+                continue
+            out.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(out)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        for p in self._parts:
+            p.close()
+
+
+def _quote(value):
+    # same escaping as urllib3 (HTML5 form encoding)
+    return str(value).translate({10: '%0A', 13: '%0D', 34: '%22'})
+
+
+def _as_stream(data, spool_size):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return BytesIO(data)
+    if not _seekable(data):
+        data = spool(data, spool_size) or BytesIO()
+    return data
+
+
+def _seekable(f):
+    try:
+        return f.seekable()
+    except (AttributeError, ValueError):
+        return hasattr(f, 'seek') and hasattr(f, 'tell')
+
+
+def _remaining(f):
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    f.seek(position)
+    return end - position
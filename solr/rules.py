@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.rules
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Parameter sanitization rules, compiled once from the configuration
+"""
+from __future__ import absolute_import
+
+from collections import namedtuple
+from types import MappingProxyType
+
+# what SolrInterface.cleanup_solr_request does with a parameter
+SNIPPETS = 'snippets'   # clamp the number of highlight snippets
+FRAGSIZE = 'fragsize'   # clamp the size of highlight fragments
+FIELDS = 'fields'       # keep only the allowed values
+FL = 'fl'               # field list, with protected fields
+ROWS = 'rows'           # clamp the number of rows
+
+# keys of the config lists used with FIELDS
+_ALLOWED_VALUES = {
+    'hl.fl': 'SOLR_SERVICE_ALLOWED_HIGHLIGHTS_FIELDS',
+    'facet.field': 'SOLR_SERVICE_ALLOWED_FACET_FIELDS',
+    'facet.pivot': 'SOLR_SERVICE_ALLOWED_FACET_PIVOT',
+    'stats.field': 'SOLR_SERVICE_ALLOWED_STATS_FIELDS',
+    'sort': 'SOLR_SERVICE_ALLOWED_SORT_FIELDS',
+}
+
+# parameters that are passed to solr untouched, listed so that the most
+# common ones skip the pattern rules
+_PASSTHROUGH = ('q', 'fq', 'start', 'wt', 'hl', 'facet', 'stats', 'defType',
+                'boostType', 'cursorMark', 'timeAllowed', 'internal_logging_params')
+
+
+class SanitizationRules(namedtuple('SanitizationRules', [
+        'disallowed_fields', 'allowed_fields', 'exact'])):
+    """
+    Immutable lookup tables for cleanup_solr_request: every parameter
+    name maps to the (action, allowed values) pairs that apply to it.
+    Well known names are resolved with a single dict lookup, any other
+    name is matched against the pattern rules (subrequests such as
+    'cites.fl', per-field highlighting such as 'f.title.hl.snippets').
+
+    Built by create_app; changes made to the config afterwards are only
+    seen by a new instance.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: dict-like, the application config
+        :return: SanitizationRules
+        """
+        allowed = {k: frozenset(config.get(v) or ()) for k, v in _ALLOWED_VALUES.items()}
+        known = _PASSTHROUGH + tuple(_ALLOWED_VALUES) + ('fl', 'rows', 'hl.snippets', 'hl.fragsize')
+        exact = {key: _match(key, allowed) for key in known}
+        return cls(
+            disallowed_fields=frozenset(config.get('SOLR_SERVICE_DISALLOWED_FIELDS') or ()),
+            allowed_fields=tuple(config.get('SOLR_SERVICE_ALLOWED_FIELDS') or ()),
+            exact=MappingProxyType(exact),
+        )
+
+    def actions(self, key):
+        """
+        :param key: string, name of a request parameter
+        :return: tuple of (action, frozenset of allowed values or None)
+        """
+        actions = self.exact.get(key)
+        if actions is None:
+            actions = _match(key, None)
+        return actions
+
+
+def _match(key, allowed):
+    """
+    The pattern rules; the checks are substring matches on purpose, so
+    that any parameter that could select fields or rows is sanitized
+
+    :param key: string, name of a request parameter
+    :param allowed: dict of frozensets (FIELDS rules only apply to the
+        exact names in _ALLOWED_VALUES, so it can be None for any other)
+    :return: tuple of (action, frozenset or None)
+    """
+    actions = []
+    if 'hl.' in key:
+        if '.snippets' in key:
+            actions.append((SNIPPETS, None))
+        elif '.fragsize' in key:
+            actions.append((FRAGSIZE, None))
+    if key == 'hl.fl':
+        actions.append((FIELDS, allowed[key]))
+    if key == 'fl' or ('.fl' in key and key != 'hl.fl'):
+        actions.append((FL, None))
+    if key == 'rows' or '.rows' in key:
+        actions.append((ROWS, None))
+    if key in _ALLOWED_VALUES and key != 'hl.fl':
+        actions.append((FIELDS, allowed[key]))
+    return tuple(actions)
@@ -0,0 +1,61 @@
+# coding=utf-8
+"""
+Compares the JSON libraries on the rewrite of a highlighted page of 200
+documents: decoding and encoding the whole response, or only its
+highlights (solr.highlight.rewrite), with and without publishers whose
+highlights must be filtered (which needs the documents to be decoded)
+
+    python -m solr.tests.benchmark_codec [number of runs]
+"""
+from __future__ import print_function
+import copy
+import json
+import sys
+import timeit
+
+from solr import codec, highlight
+from solr.tests.stubdata.solr import example_solr_response
+
+ROWS = 200
+
+
+def highlighted_page(rows=ROWS):
+    page = json.loads(example_solr_response)
+    docs = page['response']['docs']
+    page['response']['docs'] = []
+    page['highlighting'] = {}
+    for i in range(rows):
+        doc = copy.deepcopy(docs[i % len(docs)])
+        doc['id'] = str(i)
+        page['response']['docs'].append(doc)
+        abstract = doc.get('abstract', '') or ''
+        page['highlighting'][doc['id']] = {
+            'abstract': [abstract[:100] + ' <em>solar</em> ' + abstract[100:400]],
+            'body': ['x' * 300 + ' <em>solar</em> wind ' + 'y' * 300] * 3,
+        }
+    page['response']['numFound'] = rows
+    return json.dumps(page).encode('utf-8')
+
+
+def main(runs=50):
+    body = highlighted_page()
+    print('{} bytes, {} runs'.format(len(body), runs))
+    print('{:8} {:>10} {:>12} {:>12}'.format('', 'decoded', 'incremental', 'no filter'))
+    for name in codec.available():
+        c = codec.select(name)
+
+        def decoded():
+            data = c.loads(body)
+            highlight.postprocess(data, 200, frozenset(['ieee']))
+            data['filtered'] = 'true'
+            return c.dumps(data)
+
+        timings = [min(timeit.repeat(fn, number=runs, repeat=3)) / runs * 1000 for fn in (
+            decoded,
+            lambda: highlight.rewrite(body, 200, frozenset(['ieee']), c),
+            lambda: highlight.rewrite(body, 200, frozenset(), c),
+        )]
+        print('{:8} {:8.2f}ms {:10.2f}ms {:10.2f}ms'.format(name, *timings))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from solr.cache import LRUCache, DiskCache, TieredCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_size_bound(self):
+        """
+        Least recently used values are evicted once max_bytes is exceeded
+        """
+        cache = LRUCache(10)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'yyyy')
+        self.assertEqual(cache.get('a'), 'xxxx') # 'b' is now the oldest
+        cache.set('c', 'zzzz')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'xxxx')
+        self.assertEqual(cache.nbytes, 8)
+
+        # too large to be ever stored
+        self.assertFalse(cache.set('d', 'x' * 11))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        """
+        Entries expire after ttl seconds
+        """
+        cache = LRUCache(100, ttl=10)
+        with mock.patch('solr.cache.time.monotonic', return_value=100):
+            cache.set('a', 'xxxx')
+            cache.set('b', 'yyyy', ttl=30)
+        with mock.patch('solr.cache.time.monotonic', return_value=115):
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), 'yyyy')
+        self.assertEqual(cache.nbytes, 4)
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_size_bound(self):
+        """
+        Oldest files are removed once max_bytes is exceeded
+        """
+        cache = DiskCache(self.directory, 10)
+        self.assertTrue(cache.set('a', b'xxxx'))
+        os.utime(cache._path('a'), (1, 1))
+        self.assertTrue(cache.set('b', b'yyyy'))
+        self.assertEqual(cache.get('a'), b'xxxx')
+        self.assertTrue(cache.set('c', b'zzzz'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), b'yyyy')
+        self.assertEqual(cache.nbytes, 8)
+        self.assertFalse(cache.set('d', b'x' * 11))
+
+        # the store outlives the process
+        self.assertEqual(DiskCache(self.directory, 10).get('c'), b'zzzz')
+
+    def test_tiered(self):
+        """
+        Values found on disk are promoted to memory
+        """
+        disk = DiskCache(self.directory, 100)
+        disk.set('a', b'xxxx')
+        cache = TieredCache(LRUCache(100), disk)
+        self.assertIsNone(cache.memory.get('a'))
+        self.assertEqual(cache.get('a'), b'xxxx')
+        self.assertEqual(cache.memory.get('a'), b'xxxx')
+
+        cache.set('b', b'yyyy')
+        self.assertEqual(disk.get('b'), b'yyyy')
+        self.assertEqual(cache.pop('b'), b'yyyy')
+        self.assertIsNone(cache.get('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import json
+import unittest
+from solr import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_codecs(self):
+        """
+        Every installed library decodes and encodes the same documents
+        """
+        data = {'response': {'numFound': 1, 'docs': [{'id': '1', 'title': [u'été / <em>x</em>']}]},
+                'stats': {'mean': 1.5}}
+        for name in codec.available():
+            c = codec.select(name)
+            self.assertEqual(c.name, name)
+            out = c.dumps(data)
+            self.assertIsInstance(out, bytes)
+            self.assertEqual(json.loads(out.decode('utf-8')), data)
+            self.assertEqual(c.loads(json.dumps(data).encode('utf-8')), data)
+            self.assertEqual(c.loads(json.dumps(data)), data)
+            # solr writes NaN for some stats
+            self.assertTrue(c.loads(b'{"mean": NaN}')['mean'] != c.loads(b'{"mean": NaN}')['mean'])
+
+    def test_select(self):
+        """
+        The fastest installed library is the default; json always works
+        """
+        self.assertEqual(codec.select().name, codec.available()[0])
+        self.assertEqual(codec.select('json').name, 'json')
+        self.assertEqual(codec.available()[-1], 'json')
+        with self.assertRaises(ValueError):
+            codec.select('simplejson')
+
+
+if __name__ == '__main__':
+    unittest.main()
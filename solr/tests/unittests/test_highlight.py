@@ -0,0 +1,102 @@
+import json
+import unittest
+from solr import codec, highlight
+
+
+class TestHighlight(unittest.TestCase):
+
+    def test_window(self):
+        """
+        Windows are centered on the emphasized terms; overlapping
+        windows are merged
+        """
+        text = 'a' * 50 + '<em>x</em>' + 'b' * 50
+        self.assertEqual(highlight.window(text, 30), ['a' * 10 + '<em>x</em>' + 'b' * 10])
+        # cut by the start of the text: extends further right
+        self.assertEqual(highlight.window('<em>x</em>' + 'b' * 50, 30), ['<em>x</em>' + 'b' * 20])
+        # terms too long for a window are dropped
+        self.assertEqual(highlight.window('<em>' + 'x' * 40 + '</em>', 30), [])
+
+        overlapping = 'a' * 20 + '<em>x</em>' + 'c' * 5 + '<em>y</em>' + 'b' * 20
+        self.assertEqual(highlight.window(overlapping, 60), [overlapping[0:60]])
+        # the second window adds nothing
+        self.assertEqual(highlight.window(overlapping, 50), [overlapping[0:50]])
+        # merging never makes a snippet longer than max_len
+        # ...and repeats at most the part of a term the previous one cut off
+        self.assertEqual(highlight.window(overlapping, 30), [overlapping[10:40], overlapping[35:55]])
+        many = ''.join('<em>x</em>' + 'c' * 5 for _ in range(40))
+        windows = highlight.window(many, 30)
+        self.assertTrue(all(len(w) <= 30 and '<em>x</em>' in w for w in windows))
+        self.assertGreater(len(windows), 1)
+        apart = 'a' * 20 + '<em>x</em>' + 'c' * 40 + '<em>y</em>' + 'b' * 20
+        self.assertEqual(highlight.window(apart, 30), [apart[10:40], apart[60:90]])
+
+    def test_postprocess(self):
+        """
+        Restricted fields of disallowed publishers are dropped, every
+        other highlight is windowed
+        """
+        text = 'a' * 50 + '<EM>x</EM>' + 'b' * 50
+        response = {
+            'response': {'docs': [{'id': '1', 'publisher': 'IEEE'},
+                                  {'id': '2', 'publisher': ['Elsevier', 'ieee']},
+                                  {'id': '3', 'publisher': 'AAS'},
+                                  {'id': '4'}]},
+            'highlighting': {
+                '1': {'body': [text], 'title': [text]},
+                '2': {'ack': [text], 'abstract': [text]},
+                '3': {'body': [text, None, '']},
+                '4': {'body': ['no match']},
+            }
+        }
+        window = 'a' * 10 + '<EM>x</EM>' + 'b' * 10
+        highlight.postprocess(response, 30, frozenset(['ieee']))
+        self.assertEqual(response['highlighting'], {
+            '1': {'title': [window]},
+            '2': {'abstract': [window]},
+            '3': {'body': [window]},
+            '4': {'body': []},
+        })
+
+    def test_rewrite(self):
+        """
+        The serialized response gets the same highlights, everything else
+        is copied byte for byte
+        """
+        text = 'a' * 50 + '<em>x</em>' + 'b' * 50
+        response = {
+            'responseHeader': {'status': 0},
+            'response': {'docs': [{'id': '1', 'publisher': 'IEEE', 'abstract': '"highlighting": {'},
+                                  {'id': '2', 'publisher': 'AAS'}]},
+            'highlighting': {'1': {'body': [text], 'title': [text]}, '2': {'body': [text]}},
+            'facet_counts': {'facet_fields': {'year': ['2000', 1]}},
+        }
+        # highlights last (as solr writes them) or followed by other members
+        for last in (True, False):
+            if last:
+                response['highlighting'] = response.pop('highlighting')
+            body = json.dumps(response, indent=1).encode('utf-8')
+            expected = highlight.postprocess(json.loads(body), 30, frozenset(['ieee']))
+            expected['filtered'] = 'true'
+            for name in codec.available():
+                for publishers in (frozenset(['ieee']), frozenset()):
+                    out = highlight.rewrite(body, 30, publishers, codec.select(name))
+                    if publishers:
+                        self.assertEqual(json.loads(out), expected)
+                    self.assertTrue(out.startswith(body[:body.index(b'"highlighting"')]))
+                    self.assertTrue(out.endswith(b',"filtered":"true"}'))
+                    if not last:
+                        self.assertIn(body[body.index(b',\n "facet_counts"'):-2] + b',"filtered"', out)
+            response['facet_counts'] = response.pop('facet_counts')
+
+        # documents after the highlights: everything is decoded
+        response = {'highlighting': {'1': {'body': [text]}}, 'response': {'docs': [{'id': '1', 'publisher': 'ieee'}]}}
+        out = highlight.rewrite(json.dumps(response).encode('utf-8'), 30, frozenset(['ieee']), codec.select('json'))
+        self.assertEqual(json.loads(out), dict(response, highlighting={'1': {}}, filtered='true'))
+        # no highlights at all
+        out = highlight.rewrite(b'{"response": {"docs": []}}', 30, frozenset(['ieee']), codec.select('json'))
+        self.assertEqual(json.loads(out), {'response': {'docs': []}, 'filtered': 'true'})
+
+
+if __name__ == '__main__':
+    unittest.main()
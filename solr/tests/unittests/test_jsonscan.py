@@ -0,0 +1,63 @@
+import json
+import unittest
+from solr.jsonscan import value_end, first_member, find_member, decode_last_member
+
+
+class TestJsonScan(unittest.TestCase):
+
+    def test_value_end(self):
+        """
+        Values end where their closing bracket is, brackets and quotes
+        within strings do not count
+        """
+        body = b'{"a": ["x]", "y\\"}", {"b": [1, {}]}], "c": null}  '
+        self.assertEqual(value_end(body, 0), len(body) - 2)
+        self.assertEqual(value_end(body, 6), body.index(b', "c"'))
+        self.assertEqual(value_end(body, body.index(b'null')), len(body) - 3)
+        with self.assertRaises(ValueError):
+            value_end(b'{"a": "unterminated}', 0)
+        with self.assertRaises(ValueError):
+            value_end(b'{"a": [1, 2}', 0)
+
+    def test_first_member(self):
+        body = b'{"responseHeader": {"QTime": 1}, "response": {}}'
+        self.assertEqual(first_member(body), (b'responseHeader', 19, 31))
+        self.assertIsNone(first_member(b'[1]'))
+
+    def test_find_member(self):
+        """
+        Only members of the top level object are found
+        """
+        body = json.dumps({
+            'response': {'docs': [{'highlighting': 'x', 'title': '"highlighting": {}'}]},
+            'highlighting': {'1': {'highlighting': ['a']}},
+            'stats': {'highlighting': {}},
+        }).encode('utf-8') + b'\n'
+        separator, start, end = find_member(body, b'highlighting')
+        self.assertEqual(body[separator:separator + 1], b',')
+        self.assertEqual(json.loads(body[start:end]), {'1': {'highlighting': ['a']}})
+
+        self.assertIsNone(find_member(b'{"response": {"highlighting": {}}}', b'highlighting'))
+        self.assertIsNone(find_member(b'{"response": ["highlighting"]}', b'highlighting'))
+        self.assertIsNone(find_member(b'["highlighting"]', b'highlighting'))
+        self.assertEqual(find_member(b'{"highlighting": 1}', b'highlighting'), (0, 17, 18))
+
+    def test_decode_last_member(self):
+        """
+        The last member is decoded without being walked; anything else
+        is left to find_member
+        """
+        body = b'{"response": {"docs": []}, "highlighting": {"1": {"title": ["}"]}}}\n'
+        separator, start, end, value = decode_last_member(body, b'highlighting', json.loads)
+        self.assertEqual((body[separator:separator + 1], body[start:end]), (b',', b'{"1": {"title": ["}"]}}'))
+        self.assertEqual(value, {'1': {'title': ['}']}})
+
+        loads = lambda b: json.loads(b.decode('utf-8'))
+        self.assertIsNone(decode_last_member(b'{"highlighting": {}, "stats": {}}', b'highlighting', loads))
+        self.assertIsNone(decode_last_member(b'{"stats": {"highlighting": {}}}', b'highlighting', loads))
+        self.assertIsNone(decode_last_member(b'{"stats": ["highlighting"]}', b'highlighting', loads))
+        self.assertIsNone(decode_last_member(b'["highlighting"]', b'highlighting', loads))
+
+
+if __name__ == '__main__':
+    unittest.main()
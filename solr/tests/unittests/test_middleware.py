@@ -0,0 +1,61 @@
+import gzip
+import unittest
+from io import BytesIO
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from solr.middleware import GzipInput
+
+
+class TestGzipInput(unittest.TestCase):
+
+    def test_read(self):
+        """
+        The body is inflated chunk by chunk
+        """
+        data = b''.join(b'bibcode%d\n' % i for i in range(1000))
+        stream = GzipInput(BytesIO(gzip.compress(data)), len(data), chunk_size=100)
+        self.assertEqual(stream.readline(), b'bibcode0\n')
+        self.assertEqual(stream.read(9), b'bibcode1\n')
+        self.assertEqual(stream.read(), data[18:])
+        self.assertEqual(stream.read(), b'')
+
+        # only `length` bytes are read from the underlying stream
+        raw = BytesIO(gzip.compress(data) + b'garbage')
+        stream = GzipInput(raw, len(data), length=len(raw.getvalue()) - 7)
+        self.assertEqual(b''.join(stream), data)
+
+    def test_limits(self):
+        """
+        Bombs and garbage are refused
+        """
+        data = b'x' * 100000
+        stream = GzipInput(BytesIO(gzip.compress(data)), 99999, chunk_size=10)
+        self.assertRaises(RequestEntityTooLarge, stream.read)
+
+        stream = GzipInput(BytesIO(b'not gzip at all'), 1000)
+        self.assertRaises(BadRequest, stream.read)
+
+    def test_members(self):
+        """
+        Concatenated gzip members are all inflated; truncated bodies and
+        trailing garbage are refused
+        """
+        first, second = b'bibcode1\n' * 100, b'bibcode2\n' * 100
+        body = gzip.compress(first) + gzip.compress(second)
+        for chunk_size in (7, 64 * 1024):
+            stream = GzipInput(BytesIO(body), 10000, chunk_size=chunk_size)
+            self.assertEqual(stream.read(), first + second)
+
+        stream = GzipInput(BytesIO(body[:-10]), 10000, chunk_size=10)
+        self.assertRaises(BadRequest, stream.read)
+        stream = GzipInput(BytesIO(gzip.compress(first)[:-4]), 10000)
+        self.assertRaises(BadRequest, stream.read)
+
+        stream = GzipInput(BytesIO(gzip.compress(first) + b'garbage'), 10000)
+        self.assertRaises(BadRequest, stream.read)
+
+        # an empty body stays empty
+        self.assertEqual(GzipInput(BytesIO(b''), 10000).read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
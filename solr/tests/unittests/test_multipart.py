@@ -0,0 +1,51 @@
+import unittest
+import requests
+from io import BytesIO
+from solr.multipart import MultipartEncoder, spool
+
+
+class Unseekable(object):
+
+    def __init__(self, data):
+        self._data = BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+
+class TestMultipartEncoder(unittest.TestCase):
+
+    def test_same_body_as_requests(self):
+        """
+        The streamed body is byte for byte the one requests would build
+        """
+        files = {'big': ('big', 'bibcode\nfoo', 'big-query/csv'),
+                 'other': ('other"name', BytesIO(b'bibcode\nbar'), 'big-query/csv')}
+        body, content_type = requests.models.RequestEncodingMixin._encode_files(files, {})
+        boundary = content_type.split('boundary=')[1]
+
+        files['other'][1].seek(0)
+        encoder = MultipartEncoder(files, boundary=boundary)
+        self.assertEqual(encoder.content_type, content_type)
+        self.assertEqual(len(encoder), len(body))
+        self.assertEqual(b''.join(iter(lambda: encoder.read(7), b'')), body)
+        self.assertEqual(encoder.read(), b'')
+
+    def test_unseekable(self):
+        """
+        Streams that cannot tell their length are spooled first
+        """
+        encoder = MultipartEncoder({'big': ('big', Unseekable(b'x' * 100), 'big-query/csv')},
+                                   boundary='b', spool_size=10)
+        body = b''.join(encoder)
+        self.assertEqual(len(encoder), len(body))
+        self.assertTrue(body.endswith(b'x' * 100 + b'\r\n--b--\r\n'))
+
+    def test_spool(self):
+        self.assertIsNone(spool(BytesIO(b''), 10))
+        f = spool(BytesIO(b'x' * 100), 10, chunk_size=7)
+        self.assertEqual(f.read(), b'x' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from solr.rules import SanitizationRules, SNIPPETS, FRAGSIZE, FIELDS, FL, ROWS
+
+
+class TestSanitizationRules(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = SanitizationRules.from_config({
+            'SOLR_SERVICE_DISALLOWED_FIELDS': ['full', 'body'],
+            'SOLR_SERVICE_ALLOWED_FIELDS': ['id', 'bibcode'],
+            'SOLR_SERVICE_ALLOWED_FACET_FIELDS': ['year'],
+            'SOLR_SERVICE_ALLOWED_HIGHLIGHTS_FIELDS': ['title'],
+        })
+
+    def test_exact_names(self):
+        """
+        Well known parameters resolve to their actions
+        """
+        self.assertEqual(self.rules.actions('q'), ())
+        self.assertEqual(self.rules.actions('fl'), ((FL, None),))
+        self.assertEqual(self.rules.actions('rows'), ((ROWS, None),))
+        self.assertEqual(self.rules.actions('hl.snippets'), ((SNIPPETS, None),))
+        self.assertEqual(self.rules.actions('hl.fl'), ((FIELDS, frozenset(['title'])),))
+        self.assertEqual(self.rules.actions('facet.field'), ((FIELDS, frozenset(['year'])),))
+        self.assertEqual(self.rules.actions('sort'), ((FIELDS, frozenset()),))
+        self.assertEqual(self.rules.disallowed_fields, frozenset(['full', 'body']))
+        self.assertEqual(self.rules.allowed_fields, ('id', 'bibcode'))
+
+    def test_patterns(self):
+        """
+        Any other name goes through the substring rules
+        """
+        self.assertEqual(self.rules.actions('cites.fl'), ((FL, None),))
+        self.assertEqual(self.rules.actions('cites.rows'), ((ROWS, None),))
+        self.assertEqual(self.rules.actions('f.title.hl.snippets'), ((SNIPPETS, None),))
+        self.assertEqual(self.rules.actions('f.title.hl.fragsize'), ((FRAGSIZE, None),))
+        self.assertEqual(self.rules.actions('hl.requireFieldMatch'), ())
+        self.assertEqual(self.rules.actions('foo'), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,13 +6,19 @@ from flask import url_for
 import unittest
 import httpretty
 import json
+import gzip
+import requests
+import threading
+import urllib3
 from solr import app
 from werkzeug.security import gen_salt
-from werkzeug.datastructures import MultiDict
+from werkzeug.datastructures import MultiDict, FileStorage, Headers
 from io import BytesIO
 from solr.tests.mocks import MockSolrResponse
 from solr import views
 from solr.views import SolrInterface
+from solr.upstream import SessionPool, SingleFlight, Bulkhead, CircuitBreakers, Router
+from solr.cache import LRUCache
 from models import Limits, Base
 import mock
 
@@ -28,7 +34,8 @@ class TestSolrInterface(TestCase):
                'TRAP_BAD_REQUEST_ERRORS': True,
                'SOLR_SERVICE_DEFAULT_ROWS': 10,
                'SOLR_SERVICE_MAX_ROWS': 100,
-               'SOLR_SERVICE_DISALLOWED_FIELDS': ['full', 'bar']
+               'SOLR_SERVICE_DISALLOWED_FIELDS': ['full', 'bar'],
+               'SOLR_SERVICE_LIMITS_CACHE_TTL': 300,
             })
         Base.query = a.db.session.query_property()
         return a
@@ -173,6 +180,106 @@ class TestSolrInterface(TestCase):
         self.assertEqual(cleaned['fl'], u'id,bibcode,full,bar')
         self.assertEqual(cleaned['fq'], ['*:*', u'bibstem:apj', u'bibstem:apr'])
 
+    def test_limits_subrequests(self):
+        """
+        Protected fields of all subrequests are resolved with one lookup
+        """
+        si = SolrInterface()
+        with self.app.session_scope() as session:
+            session.add(Limits(uid='9', field='full', filter='bibstem:apj'))
+            session.add(Limits(uid='9', field='bar', filter='bibstem:apr'))
+            session.commit()
+
+        payload = {'fl': ['bibcode,full,cites:[subquery]'], 'cites.fl': 'bibcode,bar', 'cites.q': 'foo'}
+        with mock.patch.object(si, 'user_limits', wraps=si.user_limits) as user_limits:
+            cleaned, headers = si.cleanup_solr_request(payload, user_id='9')
+        self.assertEqual(user_limits.call_count, 1)
+        self.assertEqual(cleaned['fl'], u'bibcode,cites:[subquery],full')
+        self.assertEqual(cleaned['fq'], [u'bibstem:apj'])
+        self.assertEqual(cleaned['cites.fl'], u'bibcode,bar')
+        self.assertEqual(cleaned['cites.fq'], [u'bibstem:apr'])
+
+    def test_harvest_library(self):
+        """
+        Pages after the first one are fetched concurrently
+        """
+        docs = ['bibcode%d' % i for i in range(5)]
+
+        def get(url, params=None, **kwargs):
+            r = mock.MagicMock()
+            r.json.return_value = {'documents': docs[params['start']:params['start'] + params['rows']],
+                                   'metadata': {'num_documents': len(docs)}}
+            return r
+
+        self.app.config['BIBLIB_MAX_ROWS'] = 2
+        si = SolrInterface()
+        with mock.patch.object(self.app.client, 'get', side_effect=get) as client_get:
+            out = si._harvest_library('foo', {})
+        self.assertEqual(out['documents'], set(docs))
+        self.assertEqual(sorted(c[1]['params']['start'] for c in client_get.call_args_list), [0, 2, 4])
+
+        # biblib may repeat documents across pages, they are then fetched
+        # past num_documents
+        docs = ['bibcode0', 'bibcode1', 'bibcode1', 'bibcode2', 'bibcode3', 'bibcode4', 'bibcode5']
+        get_docs = get
+        def get(url, params=None, **kwargs):
+            r = get_docs(url, params=params)
+            r.json.return_value['metadata']['num_documents'] = 6
+            return r
+        with mock.patch.object(self.app.client, 'get', side_effect=get) as client_get:
+            out = si._harvest_library('foo', {})
+        self.assertEqual(out['documents'], set(docs))
+        self.assertEqual(sorted(c[1]['params']['start'] for c in client_get.call_args_list), [0, 2, 4, 6])
+
+    def test_library_cache(self):
+        """
+        Harvested libraries are reused while biblib reports them unchanged
+        """
+        docs = ['bibcode2', 'bibcode1', 'bibcode0']
+        metadata = {'num_documents': 3, 'date_last_modified': '2019-01-01T00:00:00'}
+
+        def get(url, params=None, **kwargs):
+            r = mock.MagicMock()
+            r.json.return_value = {'documents': docs[params['start']:params['start'] + params['rows']],
+                                   'metadata': dict(metadata)}
+            return r
+
+        self.app.solr_library_cache = LRUCache(1024)
+        si = SolrInterface()
+        with mock.patch.object(self.app.client, 'get', side_effect=get) as client_get:
+            self.assertEqual(si._get_library('foo', {}), 'bibcode\nbibcode0\nbibcode1\nbibcode2')
+            self.assertEqual(client_get.call_count, 1)
+
+            self.assertEqual(si._get_library('foo', {}), 'bibcode\nbibcode0\nbibcode1\nbibcode2')
+            self.assertEqual(client_get.call_count, 2)
+            self.assertEqual(client_get.call_args[1]['params'], {'rows': 1, 'start': 0})
+
+            docs.append('bibcode3')
+            metadata.update({'num_documents': 4, 'date_last_modified': '2019-01-02T00:00:00'})
+            self.assertEqual(si._get_library('foo', {}), 'bibcode\nbibcode0\nbibcode1\nbibcode2\nbibcode3')
+            self.assertEqual(client_get.call_count, 4)
+
+    def test_limits_cache(self):
+        """
+        Limits of a user are read from the db once, until they change
+        """
+        si = SolrInterface()
+        with self.app.session_scope() as session:
+            session.add(Limits(uid='9', field='full', filter='bibstem:apj'))
+            session.commit()
+
+        self.assertEqual(si.user_limits('9'), ((u'full', u'bibstem:apj'),))
+        self.assertEqual(si.user_limits('10'), ())
+        with mock.patch.object(self.app, 'session_scope') as session_scope:
+            self.assertEqual(si.user_limits('9'), ((u'full', u'bibstem:apj'),))
+            self.assertEqual(si.user_limits('10'), ())
+            self.assertFalse(session_scope.called)
+
+        with self.app.session_scope() as session:
+            session.query(Limits).filter_by(uid='9').first().filter = 'bibstem:apr'
+            session.commit()
+        self.assertEqual(si.user_limits('9'), ((u'full', u'bibstem:apr'),))
+
 
 class TestWebservices(TestCase):
 
@@ -204,7 +311,7 @@ class TestWebservices(TestCase):
         Test that bot requests are sent to the right endpoint
         """
         with MockSolrResponse(self.app.config['BOT_SOLR_SERVICE_SEARCH_HANDLER']):
-            r = self.client.get(url_for('search'), query_string={'q': 'star'}, headers={'Authorization': 'Bearer:GoogleBot'})
+            self.client.get(url_for('search'), query_string={'q': 'star'}, headers={'Authorization': 'Bearer:GoogleBot'})
             # At this point, an exception would have happened if the request was
             # sent to SOLR_SERVICE_SEARCH_HANDLER instead of BOT_SOLR_SERVICE_SEARCH_HANDLER
 
@@ -357,15 +464,15 @@ class TestWebservices(TestCase):
         din.json = lambda: data
 
         out = mock.MagicMock()
-        out.text = ''
+        out.content = b''
         out.status_code = 200
         out.headers = {}
 
         with mock.patch.object(self.app.client, 'get', return_value=din) as get, \
             mock.patch('solr.views.requests.post', return_value=out) as post:
-            r = self.client.post(url_for('bigquery'),
-                                 query_string={'q': 'docs(library/hHGU1Ef-TpacAhicI3J8kQ)'},
-                                 headers={'Authorization': 'Bearer foo'})
+            self.client.post(url_for('bigquery'),
+                             query_string={'q': 'docs(library/hHGU1Ef-TpacAhicI3J8kQ)'},
+                             headers={'Authorization': 'Bearer foo'})
             # it made a request to retrieve library
             get.assert_called()
             assert '/biblib/libraries/hHGU1Ef-TpacAhicI3J8kQ' in get.call_args[0][0]
@@ -468,6 +575,606 @@ class TestWebservices(TestCase):
             r = self.client.get(url_for('search'))
             self.assertIn('responseHeader', r.json)
 
+    def test_stream_responses(self):
+        """
+        Responses that need no post-processing are relayed chunk by chunk
+        """
+        self.app.config['SOLR_SERVICE_STREAM_RESPONSES'] = True
+
+        out = mock.MagicMock()
+        out.status_code = 200
+        out.ok = True
+        out.headers = {'Content-Length': '11', 'Transfer-Encoding': 'chunked',
+                       'Set-Cookie': 'sroute=abc'}
+        out.iter_content = lambda chunk_size: iter([b'{"response"', b'', b':{}}'])
+        out.content = b'{"response": {"docs": []}, "highlighting": {}}'
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertTrue(post.call_args[1]['stream'])
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json, {'response': {}})
+            self.assertEqual(r.headers['Set-Cookie'], 'sroute=abc')
+            self.assertNotIn('Transfer-Encoding', r.headers)
+            out.close.assert_called()
+
+            # highlights must be rewritten, so they are never streamed
+            r = self.client.get(url_for('search'), query_string={'q': 'star', 'hl': 'true'})
+            self.assertFalse(post.call_args[1]['stream'])
+
+    def test_raw_responses(self):
+        """
+        The body of solr is relayed as bytes, never decoded; only the
+        whitelisted headers are relayed, each cookie on its own
+        """
+        body = u'{"response": {"docs": [{"title": ["Étoiles"]}]}}'.encode('utf-8')
+        raw = urllib3.HTTPResponse(
+            body=BytesIO(body), status=200, preload_content=False,
+            headers=urllib3.HTTPHeaderDict([
+                ('Content-Type', 'text/plain'), ('Content-Length', str(len(body))),
+                ('Connection', 'keep-alive'), ('X-Solr-Node', 'solr1'),
+                ('Set-Cookie', 'sroute=abc; Expires=Wed, 21 Oct 2026 07:28:00 GMT'),
+                ('Set-Cookie', 'other=1'),
+            ]))
+        out = requests.adapters.HTTPAdapter().build_response(
+            requests.Request('POST', 'http://solr/select').prepare(), raw)
+
+        with mock.patch('solr.views.requests.post', return_value=out), \
+                mock.patch.object(requests.Response, 'text', new_callable=mock.PropertyMock) as text:
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertFalse(text.called)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data, body)
+            self.assertEqual(r.headers.getlist('Set-Cookie'),
+                             ['sroute=abc; Expires=Wed, 21 Oct 2026 07:28:00 GMT', 'other=1'])
+            self.assertEqual(r.headers['Content-Type'], 'application/json')
+            self.assertNotIn('X-Solr-Node', r.headers)
+            self.assertNotIn('Connection', r.headers)
+
+    def test_pooled_sessions(self):
+        """
+        Only requests that carry the affinity cookie re-use connections
+        """
+        self.app.solr_sessions = SessionPool()
+
+        out = mock.MagicMock()
+        out.content = b''
+        out.status_code = 200
+        out.headers = {}
+        session = mock.MagicMock()
+        session.post.return_value = out
+
+        with mock.patch.object(self.app.solr_sessions, 'get', return_value=session) as get, \
+            mock.patch('solr.views.requests.post', return_value=out) as post:
+            with self.client as c:
+                c.get(url_for('search'), query_string={'q': 'star'})
+                self.assertTrue(post.called)
+                self.assertFalse(get.called)
+
+                c.set_cookie('localhost', 'sroute', 'abc')
+                c.get(url_for('search'), query_string={'q': 'star'})
+                get.assert_called_once_with(self.app.config['SOLR_SERVICE_SEARCH_HANDLER'], {'sroute': 'abc'})
+                self.assertEqual(session.post.call_args[1]['cookies'], {'sroute': 'abc'})
+                self.assertEqual(post.call_count, 1)
+
+    def test_result_cache(self):
+        """
+        Identical queries are answered from the result cache
+        """
+        self.app.solr_result_cache = LRUCache(1024 * 1024, ttl=60)
+
+        out = mock.MagicMock()
+        out.content = b'{"response": {"docs": []}}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.get(url_for('search'), query_string='q=star&fl=id,title',
+                                headers={'X-Amzn-Trace-Id': 'Root=1'})
+            self.assertEqual(r.json, {'response': {'docs': []}})
+            r = self.client.get(url_for('search'), query_string='fl=id,title&q=star',
+                                headers={'X-Amzn-Trace-Id': 'Root=2'})
+            self.assertEqual(r.json, {'response': {'docs': []}})
+            self.assertEqual(post.call_count, 1)
+
+            # the time left before the deadline does not matter
+            self.client.get(url_for('search'), query_string='q=star&fl=id,title&timeAllowed=5000')
+            self.assertEqual(post.call_count, 1)
+
+            # bots have their own handler
+            self.client.get(url_for('search'), query_string='q=star&fl=id,title',
+                            headers={'Authorization': 'Bearer:GoogleBot'})
+            self.assertEqual(post.call_count, 2)
+
+            # cursors are never cached
+            self.client.get(url_for('search'), query_string='q=star&fl=id,title&cursorMark=*')
+            self.client.get(url_for('search'), query_string='q=star&fl=id,title&cursorMark=*')
+            self.assertEqual(post.call_count, 4)
+
+            # neither are errors
+            out.status_code = 500
+            self.client.get(url_for('search'), query_string='q=error')
+            self.client.get(url_for('search'), query_string='q=error')
+            self.assertEqual(post.call_count, 6)
+
+            # ...nor results cut short by timeAllowed
+            out.status_code = 200
+            out.content = b'{"responseHeader": {"partialResults": true, "params": {}}, "response": {"docs": []}}'
+            self.client.get(url_for('search'), query_string='q=slow')
+            self.client.get(url_for('search'), query_string='q=slow')
+            self.assertEqual(post.call_count, 8)
+
+    def test_coalesce_partial_results(self):
+        """
+        Followers do not share results cut short by timeAllowed
+        """
+        self.app.solr_singleflight = SingleFlight()
+        partial = mock.MagicMock()
+        partial.content = b'{"responseHeader": {"partialResults":true}, "response": {"docs": []}}'
+        partial.status_code = 200
+        partial.headers = {}
+        out = mock.MagicMock()
+        out.content = b'{"responseHeader": {"partialResults": false}, "response": {"docs": [{"id": "1"}]}}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch.object(self.app.solr_singleflight, 'do', return_value=(partial, True)), \
+                mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(r.json['response']['docs'], [{'id': '1'}])
+
+        with mock.patch.object(self.app.solr_singleflight, 'do', return_value=(out, True)), \
+                mock.patch('solr.views.requests.post', return_value=out) as post:
+            self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertEqual(post.call_count, 0)
+
+    def test_inline_bigquery(self):
+        """
+        Small bigqueries are sent to /select as a terms filter
+        """
+        self.app.config['SOLR_SERVICE_INLINE_BIGQUERY_MAX_DOCS'] = 3
+
+        din = mock.MagicMock()
+        din.raise_for_status = lambda: True
+        din.json = lambda: {'query': json.dumps({'query': 'q=foo', 'bigquery': 'bibcode\nfoo\nbar\nfoo'})}
+
+        out = mock.MagicMock()
+        out.content = b'{"response": {"docs": []}}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch.object(self.app.client, 'get', return_value=din), \
+            mock.patch('solr.views.requests.post', return_value=out) as post:
+            self.client.get(url_for('search'), query_string={'q': 'docs(hHGU1Ef-TpacAhicI3J8kQ)'},
+                            headers={'Authorization': 'Bearer foo'})
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_SEARCH_HANDLER'])
+            self.assertNotIn('files', post.call_args[1])
+            self.assertEqual(post.call_args[1]['data']['q'], ['{!terms f=bibcode}foo,bar'])
+            self.assertEqual(post.call_args[1]['headers']['Content-Type'], 'application/x-www-form-urlencoded')
+
+            # docs() is part of a larger query
+            self.client.get(url_for('search'), query_string={'q': 'docs(hHGU1Ef-TpacAhicI3J8kQ) year:2000'},
+                            headers={'Authorization': 'Bearer foo'})
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_BIGQUERY_HANDLER'])
+            self.assertIn('hHGU1Ef-TpacAhicI3J8kQ', post.call_args[1]['files'])
+
+            # anonymous bigquery
+            self.client.post(url_for('bigquery'), data='bibcode\nfoo\nbar', query_string='q=*:*&fl=bibcode')
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_SEARCH_HANDLER'])
+            self.assertEqual(post.call_args[1]['data']['fq'], ['{!terms f=bibcode}foo,bar'])
+
+            # too many bibcodes
+            self.client.post(url_for('bigquery'), data='bibcode\na\nb\nc\nd', query_string='q=*:*&fl=bibcode')
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_BIGQUERY_HANDLER'])
+            self.assertEqual(post.call_args[1]['params']['fq'], ['{!bitset}'])
+
+            # not bibcodes
+            self.client.post(url_for('bigquery'), data='doi\nfoo', query_string='q=*:*&fl=bibcode')
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_BIGQUERY_HANDLER'])
+
+    def test_bigquery_store(self):
+        """
+        Uploaded bigqueries can be referenced by their hash
+        """
+        self.app.solr_bigquery_store = LRUCache(1024 * 1024)
+
+        out = mock.MagicMock()
+        out.content = b'{"response": {"docs": []}}'
+        out.status_code = 200
+        out.headers = {}
+
+        bibcodes = 'bibcode\nfoo\nbar'
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.post(url_for('bigquery'), data=bibcodes, query_string='q=*:*&fl=bibcode')
+            self.assertEqual(r.status_code, 200)
+            sha = r.headers['X-Bigquery-Sha']
+            self.assertTrue(sha.startswith('sha:'))
+
+            # the same content always has the same hash, uploads are hashed in chunks
+            self.app.config['SOLR_SERVICE_STREAM_CHUNK_SIZE'] = 4
+            sent = []
+            post.side_effect = lambda url, **kwargs: sent.append(kwargs['files']['big'][1].read()) or out
+            r = self.client.post(url_for('bigquery'), content_type='multipart/form-data',
+                                 data={'q': '*:*', 'fq': '{!bitset}',
+                                       'big': (BytesIO(bibcodes.encode('utf-8')), 'big', 'big-query/csv')})
+            self.assertEqual(r.headers['X-Bigquery-Sha'], sha)
+            # and sent to solr in full
+            self.assertEqual(sent, [bibcodes.encode('utf-8')])
+            post.side_effect = None
+
+            r = self.client.get(url_for('search'), query_string={'q': '*:*', 'fq': 'docs({})'.format(sha)})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(post.call_args[0][0], self.app.config['SOLR_SERVICE_BIGQUERY_HANDLER'])
+            self.assertEqual(post.call_args[1]['files'][sha], (sha, bibcodes.encode('utf-8'), 'big-query/csv'))
+            self.assertNotIn('X-Bigquery-Sha', r.headers)
+
+            r = self.client.get(url_for('search'), query_string={'q': '*:*', 'fq': 'docs(sha:0000)'})
+            self.assertEqual(r.status_code, 404)
+
+    def test_vault_cache(self):
+        """
+        Stored queries are fetched from vault only once
+        """
+        self.app.solr_vault_cache = LRUCache(1024 * 1024)
+
+        din = mock.MagicMock()
+        din.raise_for_status = lambda: True
+        din.json = lambda: {'query': json.dumps({'query': 'q=foo', 'bigquery': 'bibcode\nfoo'})}
+
+        out = mock.MagicMock()
+        out.content = b'{"response": {"docs": []}}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch.object(self.app.client, 'get', return_value=din) as get, \
+            mock.patch('solr.views.requests.post', return_value=out) as post:
+            for q in ('docs(hHGU1Ef-TpacAhicI3J8kQ)', 'docs(hHGU1Ef-TpacAhicI3J8kQ) year:2000'):
+                self.client.get(url_for('search'), query_string={'q': q},
+                                headers={'Authorization': 'Bearer foo'})
+                self.assertEqual(post.call_args[1]['files']['hHGU1Ef-TpacAhicI3J8kQ'][1], 'bibcode\nfoo')
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(post.call_count, 2)
+
+    def test_docs_concurrently(self):
+        """
+        Several docs() streams are resolved at the same time
+        """
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get(url, **kwargs):
+            barrier.wait() # both lookups have to be in flight
+            r = mock.MagicMock()
+            if '/biblib/libraries/' in url:
+                r.json.return_value = {'documents': ['bibcode1'], 'metadata': {}}
+            else:
+                r.json.return_value = {'query': json.dumps({'query': 'q=foo', 'bigquery': 'bibcode\nbibcode2'})}
+            return r
+
+        out = mock.MagicMock()
+        out.content = b'{"response": {"docs": []}}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch.object(self.app.client, 'get', side_effect=get), \
+            mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.get(url_for('search'),
+                                query_string={'q': 'docs(library/foo) OR docs(bar)'},
+                                headers={'Authorization': 'Bearer foo'})
+            self.assertEqual(r.status_code, 200)
+            files = post.call_args[1]['files']
+            self.assertEqual(files['library/foo'][1], 'bibcode\nbibcode1')
+            self.assertEqual(files['bar'][1], 'bibcode\nbibcode2')
+
+    def test_etag(self):
+        """
+        Unchanged results are answered with a bodiless 304
+        """
+        out = mock.MagicMock()
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch('solr.views.requests.post', return_value=out):
+            out.content = b'{"responseHeader":{"QTime":3},"response":{"docs":[{"id":"1"}]}}'
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertStatus(r, 200)
+            etag = r.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+
+            # QTime is not part of the results
+            out.content = b'{"responseHeader":{"QTime":7},"response":{"docs":[{"id":"1"}]}}'
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'If-None-Match': etag})
+            self.assertStatus(r, 304)
+            self.assertEqual(r.data, b'')
+
+            out.content = b'{"responseHeader":{"QTime":7},"response":{"docs":[{"id":"2"}]}}'
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'If-None-Match': etag})
+            self.assertStatus(r, 200)
+            self.assertNotEqual(r.headers['ETag'], etag)
+
+    def test_compression(self):
+        """
+        Compressed solr responses are relayed untouched, rewritten ones
+        are compressed by the service
+        """
+        self.app.config['SOLR_SERVICE_COMPRESSION'] = True
+        self.app.config['SOLR_SERVICE_COMPRESSION_MIN_BYTES'] = 0
+        body = gzip.compress(b'{"response": {"docs": []}}')
+
+        out = mock.MagicMock()
+        out.status_code = 200
+        out.ok = True
+        out.headers = {'Content-Encoding': 'gzip', 'Content-Length': str(len(body))}
+        out.raw.read.return_value = body
+        out.content = b'{"response": {"docs": []}, "highlighting": {}}'
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(post.call_args[1]['headers']['Accept-Encoding'], 'gzip')
+            self.assertTrue(post.call_args[1]['stream'])
+            out.raw.read.assert_called_with(decode_content=False)
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', r.headers['Vary'])
+            self.assertEqual(r.data, body)
+
+            r = self.client.get(url_for('search'), query_string={'q': 'star', 'hl': 'true'},
+                                headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Accept-Encoding', post.call_args[1]['headers'])
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(r.data))['filtered'], 'true')
+
+            # the client does not accept compressed content
+            r = self.client.get(url_for('search'), query_string={'q': 'star', 'hl': 'true'})
+            self.assertNotIn('Content-Encoding', r.headers)
+            self.assertEqual(r.json['filtered'], 'true')
+
+    def test_deadline(self):
+        """
+        Every upstream call is bounded by the request deadline
+        """
+        self.app.config['SOLR_SERVICE_TIME_ALLOWED_MS'] = 60000
+        out = mock.MagicMock()
+        out.content = b''
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            self.client.get(url_for('search'), query_string={'q': 'star'})
+            connect, read = post.call_args[1]['timeout']
+            self.assertTrue(59 < read <= 61)
+            self.assertTrue(59000 < post.call_args[1]['data']['timeAllowed'] <= 60000)
+
+            # clients can ask for less
+            self.client.get(url_for('search'), query_string={'q': 'star'},
+                            headers={'X-Request-Deadline-Ms': '5000'})
+            connect, read = post.call_args[1]['timeout']
+            self.assertTrue(read <= 5)
+            self.assertTrue(post.call_args[1]['data']['timeAllowed'] <= 4000)
+
+            # ...but not more
+            self.client.get(url_for('search'), query_string={'q': 'star'},
+                            headers={'X-Request-Deadline-Ms': '500000'})
+            connect, read = post.call_args[1]['timeout']
+            self.assertTrue(read <= 61)
+
+            # short deadlines keep most of their budget for solr
+            self.client.get(url_for('search'), query_string={'q': 'star'},
+                            headers={'X-Request-Deadline-Ms': '800'})
+            self.assertTrue(500 < post.call_args[1]['data']['timeAllowed'] <= 600)
+
+            # no time left for the search: 504 right away
+            calls = post.call_count
+            with mock.patch('solr.views.Deadline.remaining', return_value=0.1):
+                r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                    headers={'X-Request-Deadline-Ms': '800'})
+            self.assertStatus(r, 504)
+            self.assertEqual(post.call_count, calls)
+
+            # cursors cannot be combined with timeAllowed
+            self.client.get(url_for('search'), query_string={'q': 'star', 'cursorMark': '*'})
+            self.assertNotIn('timeAllowed', post.call_args[1]['data'])
+
+            post.side_effect = requests.Timeout('read timeout')
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertStatus(r, 504)
+            self.assertIn('error', r.json)
+
+    def test_bulkheads(self):
+        """
+        Bots are rejected when their bulkhead is full, others are not affected
+        """
+        self.app.config['SOLR_SERVICE_BULKHEADS'] = {'bot': {'limit': 1, 'retry_after': 7}}
+        self.app.solr_bulkheads = {'bot': Bulkhead(1)}
+
+        with MockSolrResponse(self.app.config['BOT_SOLR_SERVICE_SEARCH_HANDLER']):
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'Authorization': 'Bearer:GoogleBot'})
+            self.assertStatus(r, 200)
+
+            with self.app.solr_bulkheads['bot'].slot():
+                r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                    headers={'Authorization': 'Bearer:GoogleBot'})
+                self.assertStatus(r, 503)
+                self.assertEqual(r.headers['Retry-After'], '7')
+
+        with MockSolrResponse(self.app.config['SOLR_SERVICE_SEARCH_HANDLER']):
+            with self.app.solr_bulkheads['bot'].slot():
+                r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                    headers={'Authorization': 'Bearer:NormalUser'})
+                self.assertStatus(r, 200)
+
+    def test_bulkhead_streamed_body(self):
+        """
+        The slot is held until a streamed body has been sent
+        """
+        self.app.config['SOLR_SERVICE_STREAM_RESPONSES'] = True
+        self.app.config['SOLR_SERVICE_BULKHEADS'] = {'bot': {'limit': 1}}
+        bulkhead = self.app.solr_bulkheads = {'bot': Bulkhead(1)}
+        active = []
+
+        def chunks(chunk_size):
+            for chunk in (b'{"response"', b':{}}'):
+                active.append(bulkhead['bot'].active)
+                yield chunk
+
+        out = mock.MagicMock()
+        out.status_code = 200
+        out.headers = {}
+        out.iter_content = chunks
+
+        with mock.patch('solr.views.requests.post', return_value=out):
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'Authorization': 'Bearer:GoogleBot'}, buffered=False)
+            self.assertEqual(bulkhead['bot'].active, 1)
+            self.assertEqual(b''.join(r.response), b'{"response":{}}')
+            r.close()
+            self.assertEqual(active, [1, 1])
+            self.assertEqual(bulkhead['bot'].active, 0)
+
+            # ...or closed without being read
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'Authorization': 'Bearer:GoogleBot'}, buffered=False)
+            self.assertEqual(bulkhead['bot'].active, 1)
+            r.close()
+            self.assertEqual(bulkhead['bot'].active, 0)
+
+    def test_backends(self):
+        """
+        Requests are spread over the solr instances configured for a url
+        """
+        self.app.solr_router = Router({
+            self.app.config['SOLR_SERVICE_URL']: ['http://solr1:8983/solr', 'http://solr2:8983/solr'],
+        })
+        out = mock.MagicMock()
+        out.content = b'{}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            urls = set()
+            for _ in range(20):
+                self.client.get(url_for('search'), query_string={'q': 'star'})
+                urls.add(post.call_args[0][0])
+                self.assertEqual(post.call_args[1]['headers']['Host'], post.call_args[0][0].split('/')[2])
+            self.assertEqual(urls, {'http://solr1:8983/solr/select', 'http://solr2:8983/solr/select'})
+
+            # the route set by an instance leads back to it
+            out.cookies = requests.cookies.RequestsCookieJar()
+            out.cookies.set('sroute', 'abc')
+            self.client.get(url_for('search'), query_string={'q': 'star'})
+            first = post.call_args[0][0]
+            out.cookies = requests.cookies.RequestsCookieJar()
+            self.client.set_cookie('localhost', 'sroute', 'abc')
+            urls = set()
+            for _ in range(5):
+                self.client.get(url_for('search'), query_string={'q': 'star'})
+                urls.add(post.call_args[0][0])
+            self.assertEqual(urls, {first})
+
+        r = self.client.get(url_for('statusview'))
+        self.assertEqual(len(r.json['backends'][self.app.config['SOLR_SERVICE_URL']]), 2)
+
+    def test_backend_unreachable(self):
+        """
+        An instance that cannot be reached is replaced by another one, and
+        the client gets a 502 when none is left
+        """
+        self.app.solr_router = Router({
+            self.app.config['SOLR_SERVICE_URL']: ['http://solr1:8983/solr', 'http://solr2:8983/solr'],
+        })
+        out = mock.MagicMock()
+        out.content = b'{}'
+        out.status_code = 200
+        out.headers = {}
+
+        def post(url, **kwargs):
+            if 'solr1' in url:
+                raise requests.ConnectionError('refused')
+            return out
+
+        with mock.patch('solr.views.requests.post', side_effect=post) as p:
+            for _ in range(30):
+                r = self.client.get(url_for('search'), query_string={'q': 'star'})
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(p.call_args[0][0], 'http://solr2:8983/solr/select')
+            # solr1 is ejected after a few failures
+            self.assertGreater(p.call_count, 30)
+            p.reset_mock()
+            self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertEqual(p.call_count, 1)
+
+        with mock.patch('solr.views.requests.post', side_effect=requests.ConnectionError('refused')) as p:
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertEqual(r.status_code, 502)
+            self.assertEqual(p.call_count, 2)
+
+    def test_coalesce_per_affinity(self):
+        """
+        Only requests with the same affinity cookie share a call to solr,
+        so nobody gets the route of another client
+        """
+        self.app.solr_singleflight = SingleFlight()
+        self.app.config['SOLR_SERVICE_FORWARDED_COOKIES'] = ['sroute']
+        out = mock.MagicMock()
+        out.content = b'{}'
+        out.status_code = 200
+        out.headers = {}
+
+        with mock.patch.object(self.app.solr_singleflight, 'do', return_value=(out, False)) as do:
+            keys = []
+            for route in ('leader-route', 'follower-route', 'leader-route', None):
+                if route:
+                    self.client.set_cookie('localhost', 'sroute', route)
+                else:
+                    self.client.delete_cookie('localhost', 'sroute')
+                self.client.get(url_for('search'), query_string={'q': 'star'})
+                keys.append(do.call_args[0][0])
+            self.assertNotEqual(keys[0], keys[1])
+            self.assertEqual(keys[0], keys[2])
+            self.assertNotIn('|', keys[3])
+
+    def test_circuit_breaker(self):
+        """
+        Failing solr urls are not queried until the circuit closes again
+        """
+        self.app.solr_breakers = CircuitBreakers(window=2, min_calls=2, reset_timeout=60)
+        out = mock.MagicMock()
+        out.content = b'{}'
+        out.status_code = 500
+        out.headers = {}
+
+        with mock.patch('solr.views.requests.post', return_value=out) as post:
+            for _ in range(2):
+                r = self.client.get(url_for('search'), query_string={'q': 'star'})
+                self.assertStatus(r, 500)
+
+            r = self.client.get(url_for('search'), query_string={'q': 'star'})
+            self.assertStatus(r, 503)
+            self.assertIn('Retry-After', r.headers)
+            self.assertEqual(post.call_count, 2)
+
+            # other urls are not affected
+            out.status_code = 200
+            r = self.client.get(url_for('search'), query_string={'q': 'star'},
+                                headers={'Authorization': 'Bearer:GoogleBot'})
+            self.assertStatus(r, 200)
+
+        r = self.client.get(url_for('statusview'))
+        breakers = r.json['circuit_breakers']
+        self.assertEqual(breakers[self.app.config['SOLR_SERVICE_SEARCH_HANDLER']]['state'], 'open')
+        self.assertEqual(breakers[self.app.config['BOT_SOLR_SERVICE_SEARCH_HANDLER']]['state'], 'closed')
+
+        # a half-open probe that fails with an unexpected error frees its slot
+        breaker = self.app.solr_breakers.get(self.app.config['SOLR_SERVICE_SEARCH_HANDLER'])
+        breaker.opened_at -= 61
+        with mock.patch('solr.views.requests.post', side_effect=KeyError('boom')):
+            with self.assertRaises(KeyError):
+                self.client.get(url_for('search'), query_string={'q': 'star'})
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.allow()
 
     @httpretty.activate
     def test_qtree(self):
@@ -541,6 +1248,89 @@ class TestWebservices(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('termVectors', resp.json)
 
+    @httpretty.activate
+    def test_stream_uploads(self):
+        """
+        Bigquery uploads are spooled and streamed to solr
+        """
+        received = {}
+        def request_callback(request, uri, headers):
+            received['body'] = request.body
+            received['headers'] = request.headers
+            return 200, headers, '{"response": {"docs": []}}'
+
+        httpretty.register_uri(
+            httpretty.POST, self.app.config.get('SOLR_SERVICE_BIGQUERY_HANDLER'),
+            body=request_callback)
+
+        self.app.config['SOLR_SERVICE_STREAM_UPLOADS'] = True
+        self.app.config['SOLR_SERVICE_SPOOL_BYTES'] = 16
+        bibcodes = 'bibcode\n' + '\n'.join('1907AN....174...%02d.' % i for i in range(50))
+        resp = self.client.post(url_for('bigquery'), data=bibcodes, query_string='q=*:*&fl=bibcode')
+        self.assertEqual(resp.status_code, 200)
+
+        content_type = received['headers']['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/form-data; boundary='))
+        self.assertEqual(int(received['headers']['Content-Length']), len(received['body']))
+        self.assertIn(b'Content-Disposition: form-data; name="old-bad-behaviour"; filename="old-bad-behaviour"\r\n'
+                      b'Content-Type: big-query/csv\r\n\r\n' + bibcodes.encode('utf-8') + b'\r\n',
+                      received['body'])
+
+    @httpretty.activate
+    def test_gzip_uploads(self):
+        """
+        Bigquery bodies may be gzipped, on the way in and out
+        """
+        received = {}
+        def request_callback(request, uri, headers):
+            received['body'] = request.body
+            received['headers'] = request.headers
+            return 200, headers, '{"response": {"docs": []}}'
+
+        httpretty.register_uri(
+            httpretty.POST, self.app.config.get('SOLR_SERVICE_BIGQUERY_HANDLER'),
+            body=request_callback)
+
+        bibcodes = 'bibcode\n1907AN....174...59.\n1908PA.....16..445.'
+        part = b'Content-Type: big-query/csv\r\n\r\n' + bibcodes.encode('utf-8') + b'\r\n'
+
+        # a gzipped raw body
+        resp = self.client.post(url_for('bigquery'), data=gzip.compress(bibcodes.encode('utf-8')),
+                                query_string='q=*:*&fl=bibcode', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(part, received['body'])
+
+        # a gzipped file inside a multipart body
+        upload = FileStorage(BytesIO(gzip.compress(bibcodes.encode('utf-8'))), 'bibcodes', 'big',
+                             'big-query/csv', headers=Headers({'Content-Encoding': 'gzip'}))
+        resp = self.client.post(url_for('bigquery'), content_type='multipart/form-data',
+                                data={'q': '*:*', 'fl': 'bibcode', 'fq': '{!bitset}', 'big': upload})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(part, received['body'])
+
+        # truncated parts are refused, not sent to solr as a shorter list
+        received.clear()
+        upload = FileStorage(BytesIO(gzip.compress(bibcodes.encode('utf-8'))[:-10]), 'bibcodes', 'big',
+                             'big-query/csv', headers=Headers({'Content-Encoding': 'gzip'}))
+        resp = self.client.post(url_for('bigquery'), content_type='multipart/form-data',
+                                data={'q': '*:*', 'fl': 'bibcode', 'fq': '{!bitset}', 'big': upload})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(received, {})
+
+        # a binary bitset keeps its content type
+        resp = self.client.post(url_for('bigquery'), data=b'\x00\x01\x02',
+                                query_string='q=*:*&fl=bibcode', content_type='big-query/bitset')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Content-Type: big-query/bitset\r\n\r\n\x00\x01\x02\r\n', received['body'])
+
+        # and solr can be sent gzipped uploads
+        self.app.config['SOLR_SERVICE_GZIP_UPLOADS'] = True
+        resp = self.client.post(url_for('bigquery'), data=bibcodes, query_string='q=*:*&fl=bibcode')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(received['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(int(received['headers']['Content-Length']), len(received['body']))
+        self.assertIn(part, gzip.decompress(received['body']))
+
     @httpretty.activate
     def test_bigquery(self):
         """
@@ -0,0 +1,381 @@
+import threading
+import time
+import unittest
+import mock
+from solr.upstream import SessionPool, SingleFlight, Deadline, DeadlineExceeded, \
+    Bulkhead, BulkheadFull, CircuitBreaker, CircuitBreakers, CircuitOpen, Router
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def test_sessions_per_affinity(self):
+        """
+        One session per handler url and cookie value
+        """
+        pool = SessionPool(max_sessions=2)
+        s1 = pool.get('http://solr/select', {'sroute': 'a'})
+        self.assertIs(pool.get('http://solr/select', {'sroute': 'a'}), s1)
+        self.assertIsNot(pool.get('http://solr/select', {'sroute': 'b'}), s1)
+        self.assertIsNot(pool.get('http://solr/bigquery', {'sroute': 'a'}), s1)
+        self.assertEqual(len(pool), 2)
+
+    def test_eviction_closes_session(self):
+        """
+        The least recently used session is closed when the pool is full
+        """
+        pool = SessionPool(max_sessions=1)
+        s1 = pool.get('http://solr/select', {'sroute': 'a'})
+        with mock.patch.object(s1, 'close') as close:
+            pool.get('http://solr/select', {'sroute': 'b'})
+            close.assert_called_once()
+
+    def test_session_does_not_store_cookies(self):
+        """
+        Cookies set by solr are relayed to the client, never remembered
+        """
+        pool = SessionPool()
+        s = pool.get('http://solr/select', {'sroute': 'a'})
+        self.assertFalse(s.cookies.get_policy().set_ok_domain(
+            mock.MagicMock(domain='solr'), mock.MagicMock()))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_are_shared(self):
+        """
+        Callers that arrive while a call is in flight get its result
+        """
+        sf = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return 'response'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(sf.do('key', fn)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('response', False)] + [('response', True)] * 4)
+
+        # nothing in flight anymore
+        self.assertEqual(sf.do('key', lambda: 'again'), ('again', False))
+
+    def test_errors_are_shared(self):
+        """
+        Waiting callers see the exception raised by the call in flight
+        """
+        sf = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def fn():
+            started.set()
+            release.wait(5)
+            raise ValueError('solr is down')
+
+        errors = []
+
+        def call():
+            try:
+                sf.do('key', fn)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    def test_timeout(self):
+        """
+        Callers stop waiting after the timeout and do the call themselves
+        """
+        sf = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        leader = threading.Thread(target=lambda: sf.do('key', slow))
+        leader.start()
+        started.wait(5)
+        self.assertEqual(sf.do('key', lambda: 'fast', timeout=0.05), ('fast', False))
+        release.set()
+        leader.join()
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_timeout(self):
+        """
+        Timeouts shrink with the remaining budget
+        """
+        with mock.patch('solr.upstream.time.monotonic', return_value=100):
+            deadline = Deadline(10)
+        with mock.patch('solr.upstream.time.monotonic', return_value=105):
+            self.assertEqual(deadline.timeout(connect=3), (3, 5))
+            self.assertEqual(deadline.timeout(), (5, 5))
+        with mock.patch('solr.upstream.time.monotonic', return_value=109.5):
+            self.assertEqual(deadline.timeout(connect=3), (0.5, 0.5))
+        with mock.patch('solr.upstream.time.monotonic', return_value=111):
+            self.assertEqual(deadline.remaining(), 0)
+            self.assertRaises(DeadlineExceeded, deadline.timeout)
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def test_limit_and_queue(self):
+        """
+        Requests beyond the limit wait in the queue, or are rejected
+        """
+        bh = Bulkhead(1, queue=1, timeout=5)
+        release = threading.Event()
+        entered = []
+
+        def occupy():
+            with bh.slot():
+                entered.append(1)
+                release.wait(5)
+
+        first = threading.Thread(target=occupy)
+        first.start()
+        time.sleep(0.05)
+        second = threading.Thread(target=occupy) # waits in the queue
+        second.start()
+        time.sleep(0.05)
+        self.assertEqual((bh.active, bh.waiting), (1, 1))
+
+        with self.assertRaises(BulkheadFull): # queue is full
+            with bh.slot():
+                pass
+
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(len(entered), 2)
+        self.assertEqual((bh.active, bh.waiting), (0, 0))
+
+    def test_timeout(self):
+        """
+        Requests give up waiting after the timeout
+        """
+        bh = Bulkhead(1, queue=1, timeout=0.05)
+        with bh.slot():
+            with self.assertRaises(BulkheadFull):
+                with bh.slot():
+                    pass
+        self.assertEqual(bh.waiting, 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_recover(self):
+        """
+        The circuit opens on failures, probes after the timeout and closes again
+        """
+        with mock.patch('solr.upstream.time.monotonic', return_value=100):
+            cb = CircuitBreaker('http://solr', window=4, min_calls=4, failure_ratio=0.5, reset_timeout=10)
+            for ok in (True, True, False, True):
+                cb.allow()
+                cb.record(ok)
+            self.assertEqual(cb.state, cb.CLOSED)
+            cb.allow()
+            cb.record(False)
+            self.assertEqual(cb.state, cb.OPEN)
+            self.assertRaises(CircuitOpen, cb.allow)
+
+        with mock.patch('solr.upstream.time.monotonic', return_value=111):
+            probe = cb.allow()
+            self.assertEqual(cb.state, cb.HALF_OPEN)
+            self.assertRaises(CircuitOpen, cb.allow) # only one probe at a time
+            cb.record(False, probe=probe)
+            self.assertEqual(cb.state, cb.OPEN)
+
+        with mock.patch('solr.upstream.time.monotonic', return_value=122):
+            probe = cb.allow()
+            # calls let through while the circuit was closed do not decide
+            cb.record(True)
+            cb.record(True, probe=probe - 1)
+            self.assertEqual(cb.state, cb.HALF_OPEN)
+            cb.record(True, probe=probe)
+            self.assertEqual(cb.state, cb.CLOSED)
+            self.assertEqual(cb.status(), {'state': 'closed', 'calls': 0, 'failures': 0})
+
+    def test_release(self):
+        """
+        A probe that ends without an outcome frees its slot
+        """
+        cb = CircuitBreaker('http://solr', window=1, min_calls=1, reset_timeout=0)
+        cb.record(False)
+        self.assertEqual(cb.state, cb.OPEN)
+        for _ in range(3):
+            probe = cb.allow()
+            self.assertEqual(cb.state, cb.HALF_OPEN)
+            cb.release(probe)
+        cb.allow()
+        with self.assertRaises(CircuitOpen):
+            cb.allow()
+
+    def test_slow_calls(self):
+        """
+        Calls slower than the threshold count as failures
+        """
+        cb = CircuitBreaker('http://solr', window=2, min_calls=2, failure_ratio=1, slow_call_seconds=1)
+        cb.record(True, elapsed=2)
+        cb.record(True, elapsed=0.5)
+        self.assertEqual(cb.state, cb.CLOSED)
+        cb.record(True, elapsed=3)
+        self.assertEqual(cb.state, cb.CLOSED)
+        cb.record(True, elapsed=3)
+        self.assertEqual(cb.state, cb.OPEN)
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.breakers = CircuitBreakers(window=1, min_calls=1, reset_timeout=60)
+        self.router = Router({
+            'http://solr/solr': [{'url': 'http://solr1/solr', 'weight': 3}, 'http://solr2/solr',
+                                 {'url': 'http://solr3/solr', 'weight': 0}],
+        }, breakers=self.breakers)
+
+    def test_weights(self):
+        """
+        Instances get traffic in proportion to their weight, other urls
+        are not routed
+        """
+        hits = [self.router.route('http://solr/solr/select') for _ in range(2000)]
+        self.assertEqual(set(hits), {'http://solr1/solr/select', 'http://solr2/solr/select'})
+        self.assertTrue(1300 < hits.count('http://solr1/solr/select') < 1700)
+        self.assertEqual(self.router.route('http://other/solr/select'), 'http://other/solr/select')
+        self.assertEqual(self.router.route('http://solr/solrx/select'), 'http://solr/solrx/select')
+
+    def test_affinity(self):
+        """
+        The same cookie always goes to the same instance, unless it is
+        unavailable
+        """
+        routes = {}
+        for i in range(50):
+            cookies = {'sroute': str(i)}
+            routes[i] = self.router.route('http://solr/solr/select', cookies)
+            for _ in range(3):
+                self.assertEqual(self.router.route('http://solr/solr/select', cookies), routes[i])
+        self.assertEqual(set(routes.values()), {'http://solr1/solr/select', 'http://solr2/solr/select'})
+
+        # only the clients of the failing instance move
+        self.router.pools['http://solr/solr'][1].healthy = False
+        for i, url in routes.items():
+            self.assertEqual(self.router.route('http://solr/solr/select', {'sroute': str(i)}),
+                             'http://solr1/solr/select')
+
+    def test_remembered_routes(self):
+        """
+        A cookie goes back to the instance that set it, whatever its hash
+        """
+        url = 'http://solr/solr/select'
+        hashed = self.router.route(url, {'sroute': 'abc'})
+        other = ({'http://solr1/solr/select', 'http://solr2/solr/select'} - {hashed}).pop()
+        self.router.remember(other, {'sroute': 'abc'})
+        for _ in range(5):
+            self.assertEqual(self.router.route(url, {'sroute': 'abc', 'foo': 'bar'}), other)
+        # ...while it is available
+        self.router.pools['http://solr/solr'][0 if 'solr1' in other else 1].healthy = False
+        self.assertEqual(self.router.route(url, {'sroute': 'abc'}), hashed)
+
+        self.router.max_routes = 1
+        self.router.remember('http://solr2/solr/select', {'sroute': 'def'})
+        self.router.remember('http://unknown/solr/select', {'sroute': 'ghi'})
+        self.assertEqual(list(self.router._routes), [('sroute', 'def')])
+
+    def test_probes_start_in_each_process(self):
+        """
+        The probe thread is started by the first request of a process
+        """
+        with mock.patch.object(Router, 'probe') as probe:
+            self.router.start(60)
+            self.assertIsNone(self.router._thread)
+            self.router.route('http://solr/solr/select')
+            thread = self.router._thread
+            self.assertTrue(thread.is_alive())
+            self.router.route('http://solr/solr/select')
+            self.assertIs(self.router._thread, thread)
+
+            self.router.stop()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+
+            # a forked worker starts its own
+            with mock.patch('solr.upstream.os.getpid', return_value=-1):
+                self.router.route('http://solr/solr/select')
+            self.assertIsNot(self.router._thread, thread)
+            self.assertTrue(self.router._thread.is_alive())
+            self.router.stop()
+            self.router._thread.join(1)
+            self.assertTrue(probe.called)
+
+    def test_ejection(self):
+        """
+        Instances failing their ping or with an open breaker are skipped,
+        as long as there is an alternative
+        """
+        with mock.patch('solr.upstream.requests.get') as get:
+            get.side_effect = lambda url, **kwargs: mock.MagicMock(ok='solr1' not in url)
+            self.router.probe()
+            self.assertEqual(get.call_args[0][0], 'http://solr3/solr/admin/ping')
+        self.assertEqual({self.router.route('http://solr/solr/select') for _ in range(50)},
+                         {'http://solr2/solr/select'})
+        self.assertFalse(self.router.status()['http://solr/solr'][0]['healthy'])
+
+        self.breakers.get('http://solr2/solr/select').record(False)
+        # nothing left: the configured instances are tried anyway
+        self.assertIn(self.router.route('http://solr/solr/select'),
+                      {'http://solr1/solr/select', 'http://solr2/solr/select'})
+        # the breakers are per url
+        self.assertEqual(self.router.route('http://solr/solr/bigquery'), 'http://solr2/solr/bigquery')
+
+    def test_passive_ejection(self):
+        """
+        Instances that keep failing are skipped for a while, without
+        circuit breakers too
+        """
+        router = Router({'http://solr/solr': ['http://solr1/solr', 'http://solr2/solr']},
+                        eject_after=2, eject_seconds=30)
+        router.record('http://solr1/solr/select', False)
+        router.record('http://solr1/solr/select', True)
+        router.record('http://solr1/solr/select', False)
+        self.assertEqual(len({router.route('http://solr/solr/select') for _ in range(50)}), 2)
+
+        router.record('http://solr1/solr/select', False)
+        self.assertEqual({router.route('http://solr/solr/select') for _ in range(50)},
+                         {'http://solr2/solr/select'})
+        with mock.patch('solr.upstream.time.monotonic', return_value=time.monotonic() + 31):
+            self.assertEqual(len({router.route('http://solr/solr/select') for _ in range(50)}), 2)
+
+        # the instances already tried for a request are not returned again
+        self.assertEqual(router.route('http://solr/solr/select', exclude={'http://solr2/solr/select'}),
+                         'http://solr1/solr/select')
+        self.assertIsNone(router.route('http://solr/solr/select',
+                                       exclude={'http://solr1/solr/select', 'http://solr2/solr/select'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+"""
+    solr.upstream
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Plumbing for the outgoing connections to solr
+"""
+from __future__ import absolute_import
+
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool(object):
+    """
+    Keeps one requests.Session (i.e. one pool of keep-alive connections)
+    per solr handler url and value of the affinity cookie(s).
+
+    Solr ingress only sets the `sroute` cookie on a fresh connection, so
+    requests that do not carry the cookie yet must not use this pool;
+    once a client has the cookie, every connection in its pool points at
+    the same solr instance and can be safely reused.
+    """
+
+    def __init__(self, max_sessions=128, pool_maxsize=10):
+        """
+        :param max_sessions: int, number of sessions kept alive; the least
+            recently used session is closed when the limit is reached
+        :param pool_maxsize: int, number of connections kept per session
+        """
+        self.max_sessions = max_sessions
+        self.pool_maxsize = pool_maxsize
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url, cookies):
+        """
+        :param url: string, solr handler url
+        :param cookies: dict, affinity cookies forwarded with the request
+        :return: requests.Session dedicated to (url, cookies)
+        """
+        key = (url, tuple(sorted(cookies.items())))
+        evicted = []
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None:
+                session = self._new_session()
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        for s in evicted:
+            s.close()
+        return session
+
+    def clear(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for s in sessions:
+            s.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _new_session(self):
+        session = requests.Session()
+        # cookies are forwarded explicitly with every request; the session
+        # must not remember the ones solr sets, or it would pin a client to
+        # a stale route after the ingress has moved it
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share the same key: the first caller
+    does the work while the others wait and get the very same result
+    (or exception) instead of repeating the call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """
+        :param key: hashable, identifies equivalent calls
+        :param fn: callable without arguments
+        :param timeout: float, seconds to wait for the call in flight;
+            when exceeded the caller gives up waiting and calls `fn` itself
+        :return: tuple - (result of fn, bool: result was shared)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of the request ran out"""
+    pass
+
+
+class Deadline(object):
+    """
+    Time budget of an incoming request, shared by all the calls made on
+    its behalf (vault, biblib, solr)
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """:return: float, seconds left (never negative)"""
+        return max(0.0, self.expires - time.monotonic())
+
+    def timeout(self, connect=None):
+        """
+        :param connect: float, upper bound for the connect timeout
+        :return: tuple - (connect, read) timeout for requests
+        :raise DeadlineExceeded: if there is no time left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('Request exceeded its deadline of {:.3f}s'.format(self.seconds))
+        return (min(connect, remaining) if connect else remaining), remaining
+
+
+class BulkheadFull(Exception):
+    """No slot became available in the bulkhead"""
+    pass
+
+
+class Bulkhead(object):
+    """
+    Limits how many requests of one kind are processed at the same time;
+    a bounded number of extra requests may wait for a free slot, the
+    rest is rejected right away.
+    """
+
+    def __init__(self, limit, queue=0, timeout=None):
+        """
+        :param limit: int, requests processed concurrently
+        :param queue: int, requests allowed to wait for a slot
+        :param timeout: float, seconds a request waits at most
+        """
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        """
+        :raise BulkheadFull: if the request has to be rejected
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    raise BulkheadFull()
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                raise BulkheadFull()
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
+
+
+class CircuitOpen(Exception):
+    """Calls to the upstream are currently refused"""
+
+    def __init__(self, url, retry_after):
+        Exception.__init__(self, 'Circuit for {} is open'.format(url))
+        self.url = url
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Watches the outcome of the calls made to one upstream url; when too
+    many of the recent ones failed (errors, 5xx or too slow) the circuit
+    opens and calls are refused right away for `reset_timeout` seconds.
+    After that a limited number of probe calls are let through (half-open
+    state): a successful probe closes the circuit, a failed one opens it
+    again.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, url, window=20, min_calls=10, failure_ratio=0.5,
+                 slow_call_seconds=None, reset_timeout=30, half_open_calls=1):
+        """
+        :param url: string, the upstream being watched
+        :param window: int, number of recent calls considered
+        :param min_calls: int, calls needed before the circuit can open
+        :param failure_ratio: float, share of failed calls that opens it
+        :param slow_call_seconds: float, calls slower than this count as
+            failures (None: latency is ignored)
+        :param reset_timeout: float, seconds the circuit stays open
+        :param half_open_calls: int, probes allowed at the same time
+        """
+        self.url = url
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._outcomes = deque(maxlen=window)
+        self._probes = 0
+        self._half_opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: token of the probe to pass on to record/release, or None
+            if the call is not a half-open probe
+        :raise CircuitOpen: if the call must not be made
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                waited = time.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    raise CircuitOpen(self.url, self.reset_timeout - waited)
+                self.state = self.HALF_OPEN
+                self._probes = 0
+                self._half_opened += 1
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    raise CircuitOpen(self.url, self.reset_timeout)
+                self._probes += 1
+                return self._half_opened
+            return None
+
+    def record(self, ok, elapsed=0.0, probe=None):
+        """
+        Only the probes of the current half-open state decide whether the
+        circuit closes; calls let through before that are ignored then.
+
+        :param ok: bool, the call succeeded
+        :param elapsed: float, seconds the call took
+        :param probe: token returned by allow()
+        """
+        failed = not ok or (self.slow_call_seconds is not None and elapsed > self.slow_call_seconds)
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if probe != self._half_opened:
+                    return
+                self._probes -= 1
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                return
+            if probe is not None:
+                # late probe of an earlier half-open state
+                return
+            self._outcomes.append(failed)
+            if self.state == self.CLOSED and len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+                self._open()
+
+    def release(self, probe=None):
+        """
+        Gives back the probe slot taken by allow() when the call ended
+        without an outcome to record (e.g. it failed before reaching the
+        upstream), so the half-open state does not run out of probes
+
+        :param probe: token returned by allow()
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and probe == self._half_opened and self._probes > 0:
+                self._probes -= 1
+
+    def is_open(self):
+        """:return: bool, calls are being refused (no probe is due yet)"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def status(self):
+        """:return: dict, describes the breaker (e.g. for /status)"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'calls': len(self._outcomes),
+                'failures': sum(self._outcomes),
+            }
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+class CircuitBreakers(object):
+    """One CircuitBreaker per upstream url, created on first use"""
+
+    def __init__(self, **settings):
+        """
+        :param settings: passed on to every CircuitBreaker
+        """
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(url, CircuitBreaker(url, **self.settings))
+        return breaker
+
+    def status(self):
+        return {url: breaker.status() for url, breaker in list(self._breakers.items())}
+
+
+class Backend(object):
+    """One solr instance behind a routed url"""
+    __slots__ = ('url', 'weight', 'healthy', 'failures', 'ejected_until')
+
+    def __init__(self, url, weight=1):
+        self.url = url.rstrip('/')
+        self.weight = weight
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+class Router(object):
+    """
+    Spreads the requests sent to a solr url over several instances, in
+    proportion to their weights. A route cookie set by solr (or its
+    ingress) is remembered along with the instance that answered, see
+    remember, so later requests carrying it go back to that instance
+    while it is available. Cookies this process has not seen set are
+    hashed onto an instance (rendezvous hashing), which is stable too and
+    only moves the clients of an instance that goes away.
+
+    An instance gets no traffic while its ping handler fails (active
+    probes, see start), for `eject_seconds` after `eject_after` calls in
+    a row failed (passive ejection, see record) and while the circuit
+    breaker of the url it would get is open. Instances are drained by
+    failing their ping, or configured out with weight 0.
+    """
+
+    def __init__(self, backends, breakers=None, ping_path='/admin/ping', probe_timeout=2,
+                 max_routes=100000, eject_after=3, eject_seconds=30):
+        """
+        :param backends: dict, base url -> list of instances, each one a
+            url or a dict with 'url' and 'weight'
+        :param breakers: CircuitBreakers, consulted for passive ejection
+        :param ping_path: string, appended to the url of an instance
+        :param probe_timeout: float, seconds
+        :param max_routes: int, route cookies remembered (least recently
+            used ones are forgotten first)
+        :param eject_after: int, failed calls in a row that eject an instance
+        :param eject_seconds: float, how long an ejected instance is skipped
+        """
+        self.pools = {}
+        for base, instances in backends.items():
+            self.pools[base.rstrip('/')] = [
+                Backend(i) if isinstance(i, str) else Backend(i['url'], i.get('weight', 1))
+                for i in instances
+            ]
+        # longest base first, so the most specific one wins
+        self._bases = sorted(self.pools, key=len, reverse=True)
+        self.breakers = breakers
+        self.ping_path = ping_path
+        self.probe_timeout = probe_timeout
+        self.max_routes = max_routes
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._routes = OrderedDict()
+        self._lock = threading.Lock()
+        self.probe_interval = None
+        self._probing_pid = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def route(self, url, cookies=None, exclude=()):
+        """
+        :param url: string, solr handler url
+        :param cookies: dict, affinity cookies forwarded with the request
+        :param exclude: set of urls returned before for this request, that
+            must not be returned again
+        :return: string, the url on the chosen instance (or url itself if
+            it is not routed); None when every instance was excluded
+        """
+        self._ensure_probes()
+        for base in self._bases:
+            if url == base or url.startswith(base + '/'):
+                break
+        else:
+            return url
+        path = url[len(base):]
+        if url in exclude:
+            return None
+        instances = [b for b in self.pools[base] if b.url + path not in exclude]
+        if not instances:
+            return None
+        pool = [b for b in instances if b.weight > 0]
+        available = [b for b in pool if b.healthy and not self._ejected(b, path)]
+        # with nothing left, trying is better than refusing outright
+        candidates = available or pool or instances
+        if cookies:
+            backend = self._remembered(cookies, candidates)
+            if backend is None:
+                key = '&'.join('{}={}'.format(k, v) for k, v in sorted(cookies.items()))
+                backend = max(candidates, key=lambda b: _rendezvous_score(key, b))
+        else:
+            backend = random.choices(candidates, weights=[b.weight for b in candidates])[0] \
+                if any(b.weight for b in candidates) else random.choice(candidates)
+        return backend.url + path
+
+    def remember(self, url, cookies):
+        """
+        Records the instance that set route cookies
+
+        :param url: string, url returned by route
+        :param cookies: dict, affinity cookies set by the response
+        """
+        backend = self._backend_of(url)
+        if backend is None:
+            return
+        with self._lock:
+            for item in cookies.items():
+                self._routes.pop(item, None)
+                self._routes[item] = backend
+            while len(self._routes) > self.max_routes:
+                self._routes.popitem(last=False)
+
+    def _remembered(self, cookies, candidates):
+        with self._lock:
+            for item in sorted(cookies.items()):
+                backend = self._routes.get(item)
+                if backend is not None:
+                    self._routes.move_to_end(item)
+                    if backend in candidates:
+                        return backend
+        return None
+
+    def _backend_of(self, url):
+        for pool in self.pools.values():
+            for backend in pool:
+                if url == backend.url or url.startswith(backend.url + '/'):
+                    return backend
+        return None
+
+    def probe(self):
+        """Pings every instance once and records whether it is healthy"""
+        for pool in self.pools.values():
+            for backend in pool:
+                try:
+                    r = requests.get(backend.url + self.ping_path, params={'wt': 'json'},
+                                     timeout=self.probe_timeout)
+                    backend.healthy = r.ok
+                except requests.RequestException:
+                    backend.healthy = False
+
+    def start(self, interval):
+        """
+        Probes the instances every `interval` seconds from a daemon thread.
+        Threads do not survive a fork, so the thread is actually started by
+        the first request routed in each process (e.g. every worker of a
+        pre-forking server that loaded the app in its master)
+        """
+        self.probe_interval = interval
+
+    def stop(self):
+        self._stopped.set()
+
+    def _ensure_probes(self):
+        if not self.probe_interval or self._probing_pid == os.getpid():
+            return
+        with self._lock:
+            if self._probing_pid == os.getpid():
+                return
+            self._probing_pid = os.getpid()
+            stopped = self._stopped = threading.Event()
+
+            def run():
+                while True:
+                    self.probe()
+                    if stopped.wait(self.probe_interval):
+                        break
+            self._thread = threading.Thread(target=run, name='solr-router-probes', daemon=True)
+            self._thread.start()
+
+    def status(self):
+        """:return: dict, describes the instances (e.g. for /status)"""
+        return {base: [{'url': b.url, 'weight': b.weight, 'healthy': b.healthy} for b in pool]
+                for base, pool in self.pools.items()}
+
+    def record(self, url, ok):
+        """
+        :param url: string, url returned by route
+        :param ok: bool, the instance answered (without a server error)
+        """
+        backend = self._backend_of(url)
+        if backend is None:
+            return
+        with self._lock:
+            if ok:
+                backend.failures = 0
+                return
+            backend.failures += 1
+            if backend.failures >= self.eject_after:
+                backend.failures = 0
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def _ejected(self, backend, path):
+        if backend.ejected_until > time.monotonic():
+            return True
+        return self.breakers is not None and self.breakers.get(backend.url + path).is_open()
+
+
+def _rendezvous_score(key, backend):
+    # weighted rendezvous hashing: -weight / ln(u), u uniform in (0, 1)
+    digest = hashlib.sha1((key + '|' + backend.url).encode('utf-8')).digest()
+    u = (int.from_bytes(digest[:8], 'big') + 0.5) / 2 ** 64
+    return -backend.weight / math.log(u)
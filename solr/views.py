@@ -1,12 +1,17 @@
 from __future__ import absolute_import
 
+import hashlib
+import os
 import re
+import sys
+import time
+from collections.abc import Iterator, Mapping
 
 from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from past.builtins import basestring
-from flask import current_app, request
+from flask import current_app, request, after_this_request
 from flask_restful import Resource
 from flask_discoverer import advertise
 try:
@@ -15,17 +20,27 @@ except ImportError:
     # If solr service is not shipped with adsws, this will fail and it is ok
     pass
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from .models import Limits
-from sqlalchemy import or_
-from werkzeug.datastructures import MultiDict
+from . import codec, highlight
+from .jsonscan import first_member
+from .middleware import GzipInput
+from .multipart import MultipartEncoder, FORM_MIMETYPES, spool, gzip_spool
+from .rules import SanitizationRules, SNIPPETS, FRAGSIZE, FIELDS, FL, ROWS
+from .upstream import Deadline, DeadlineExceeded, BulkheadFull, CircuitOpen
+from werkzeug.datastructures import MultiDict, Headers
 from io import StringIO
 from io import BytesIO
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlsplit
 from typing import List
 
+from werkzeug.exceptions import NotFound
+from requests.cookies import RequestsCookieJar
 import requests # Do not use current_app.client but requests, to avoid re-using
                 # connections from a pool which would make solr ingress nginx
-                # not set cookies with the affinity hash sroute
+                # not set cookies with the affinity hash sroute; requests that
+                # already carry the cookie may use current_app.solr_sessions
 
 class StatusView(Resource):
     """Returns the status of this app"""
@@ -34,15 +49,111 @@ class StatusView(Resource):
     decorators = [advertise('scopes', 'rate_limit')]
 
     def get(self):
-        return {'app': current_app.name, 'status': 'online'}, 200
+        status = {'app': current_app.name, 'status': 'online'}
+        breakers = getattr(current_app, 'solr_breakers', None)
+        if breakers is not None:
+            status['circuit_breakers'] = breakers.status()
+        router = getattr(current_app, 'solr_router', None)
+        if router is not None:
+            status['backends'] = router.status()
+        return status, 200
+
+def fail_fast(method):
+    """
+    Answers with 504 when solr, or any service queried on behalf of the
+    request, did not respond within the request deadline, with 503 when
+    the circuit breaker of the solr url refuses the call and with 502 when
+    solr cannot be reached
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (requests.Timeout, DeadlineExceeded) as e:
+            current_app.logger.error("Request timed out: {}".format(e))
+            return json.dumps({'error': 'Request could not be completed within the time allowed'}), 504
+        except CircuitOpen as e:
+            current_app.logger.error(str(e))
+            return json.dumps({'error': 'Search service is temporarily unavailable, retry later'}), \
+                503, {'Retry-After': str(int(e.retry_after) + 1)}
+        except requests.ConnectionError as e:
+            current_app.logger.error("Solr could not be reached: {}".format(e))
+            return json.dumps({'error': 'Search service is unreachable, retry later'}), 502
+    return wrapper
+
+
+def bulkhead(method):
+    """
+    Runs the request within the bulkhead of its handler class (see
+    SOLR_SERVICE_BULKHEADS), so that e.g. bots cannot occupy every worker;
+    must decorate the bound method, i.e. come first in method_decorators
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        bulkheads = getattr(current_app, 'solr_bulkheads', None)
+        if not bulkheads:
+            return method(*args, **kwargs)
+        handler_class = method.__self__.get_handler_class()
+        if handler_class not in bulkheads:
+            return method(*args, **kwargs)
+        slot = bulkheads[handler_class].slot()
+        try:
+            slot.__enter__()
+        except BulkheadFull:
+            settings = current_app.config['SOLR_SERVICE_BULKHEADS'][handler_class]
+            current_app.logger.warning("Rejecting '{}' request, too many of them in progress".format(handler_class))
+            return json.dumps({'error': 'Too many requests in progress, retry later'}), \
+                settings.get('status', 503), {'Retry-After': str(settings.get('retry_after', 1))}
+        try:
+            result = method(*args, **kwargs)
+        except BaseException:
+            slot.__exit__(*sys.exc_info())
+            raise
+        if isinstance(result, tuple) and isinstance(result[0], Iterator):
+            # a streamed body is sent after the view returns: the slot is
+            # held until the server closes it
+            return (_ClosingChunks(result[0], lambda: slot.__exit__(None, None, None)),) + result[1:]
+        slot.__exit__(None, None, None)
+        return result
+    return wrapper
+
+
+class _ClosingChunks(object):
+    """
+    Iterator over the chunks of a streamed body that calls `on_close`
+    once, when it is closed (even if it was never iterated)
+    """
+
+    def __init__(self, chunks, on_close):
+        self._chunks = chunks
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is None:
+            return
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            on_close()
+
 
 class SolrInterface(Resource):
     """Base class that responsible for forwarding a query to Solr"""
     handler = {'default': 'SOLR_SERVICE_URL', 'default_embedded_bigquery': 'SOLR_SERVICE_BIGQUERY_HANDLER'}
+    method_decorators = [bulkhead, fail_fast]
 
     def __init__(self, *args, **kwargs):
         Resource.__init__(self, *args, **kwargs)
         self._host = None
+        self.deadline = None
         self.internal_logging_params = {
             'X-Amzn-Trace-Id': 'Root=-',
         } # Pass to solr only for logging purposes, note that this will be returned back to the user by solr
@@ -51,6 +162,7 @@ class SolrInterface(Resource):
         return "default"
 
     def get(self):
+        self.deadline = self.request_deadline()
         query, headers = self.cleanup_solr_request(request.args.to_dict(flat=False))
 
         # trickery, we can accept docs() operator if it is part of form data
@@ -66,12 +178,35 @@ class SolrInterface(Resource):
 
         handler_class = self.get_handler_class()
         files = self.check_for_embedded_bigquery(query, request, headers, handler_class=handler_class)
+        files = self.inline_bigquery(query, headers, files)
         if files and len(files): # must be directed to /bigquery
             handler_class += '_embedded_bigquery'
         handler = self.handler.get(handler_class, self.handler.get("default"))
 
         should_postprocess_response = self.preprocess_request(handler, query)
 
+        cache_key = None
+        result_cache = getattr(current_app, 'solr_result_cache', None)
+        if result_cache is not None and not files and 'cursorMark' not in query:
+            cache_key = _canonical_key(handler_class, handler, query)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                current_app.logger.info("Serving cached response for endpoint '{}'".format(current_app.config[handler]))
+                return cached, 200, {}
+
+        # content streams can be read only once, so such requests are never shared
+        singleflight = getattr(current_app, 'solr_singleflight', None)
+        if files:
+            singleflight = None
+
+        # cached and shared responses have to be read in full anyway
+        relay = not should_postprocess_response and cache_key is None and singleflight is None
+        stream = relay and current_app.config.get('SOLR_SERVICE_STREAM_RESPONSES', False)
+        # ...and are compressed by us for each client, see create_app
+        encoded = relay and current_app.config.get('SOLR_SERVICE_COMPRESSION', False)
+        if encoded:
+            headers['Accept-Encoding'] = request.headers.get('Accept-Encoding', 'identity')
+
         try:
             current_user_id = current_user.get_id()
         except:
@@ -81,32 +216,120 @@ class SolrInterface(Resource):
         current_app.logger.info("Dispatching 'POST' request to endpoint '{}' for user '{}'".format(current_app.config[self.handler[handler_class]], current_user_id or "anonymous"))
 
         if files and len(files): # must be directed to /bigquery
-            r = requests.post(
+            r = self.post_to_solr(
                 current_app.config[handler],
                 params=query,
                 headers=headers,
                 files=files,
                 cookies=SolrInterface.set_cookies(request),
+                stream=stream or encoded,
             )
+        elif singleflight is not None:
+            # identical requests in flight wait for the first one and share its
+            # response, Set-Cookie included: only requests that carry the same
+            # affinity cookies are identical, or a follower would be moved to
+            # the solr instance of the leader
+            cookies = SolrInterface.set_cookies(request)
+            r, shared = singleflight.do(
+                _coalescing_key(cache_key or _canonical_key(handler_class, handler, query), cookies),
+                lambda: _buffered(self.post_to_solr(
+                    current_app.config[handler],
+                    data=query,
+                    headers=headers,
+                    cookies=cookies,
+                )),
+                timeout=self.coalesce_timeout(),
+            )
+            if shared and _partial_results(r.content):
+                # the leader ran out of time, a follower may well not
+                r = self.post_to_solr(
+                    current_app.config[handler],
+                    data=query,
+                    headers=headers,
+                    cookies=cookies,
+                )
+            elif shared:
+                current_app.logger.info("Sharing response of an identical request in flight to endpoint '{}'".format(current_app.config[handler]))
         else:
-            r = requests.post(
+            r = self.post_to_solr(
                 current_app.config[handler],
                 data=query,
                 headers=headers,
                 cookies=SolrInterface.set_cookies(request),
+                stream=stream or encoded,
             )
         current_app.logger.info("Received response from from endpoint '{}' with status code '{}'".format(current_app.config[handler], r.status_code))
 
         # Run this if we've identified a need to alter the response from Solr
         if should_postprocess_response and r.ok:
             try:
-                response_data = self.postprocess_response(r)
+                data = self.postprocess_response(r)
 
-                return json.dumps(response_data), r.status_code, r.headers
+                self.cache_response(cache_key, data, r.status_code)
+                return data, r.status_code, _clean_headers(r)
             except Exception as e:
                 current_app.logger.error(e.with_traceback())
 
-        return r.text, r.status_code, r.headers
+        if stream:
+            return self.stream_response(r, decode_content=not encoded)
+        if encoded:
+            return self.encoded_response(r)
+        self.cache_response(cache_key, r.content, r.status_code)
+        return r.content, r.status_code, _clean_headers(r)
+
+    def request_deadline(self):
+        """
+        Time budget for the current request: SOLR_SERVICE_DEADLINE_MS, or
+        SOLR_SERVICE_TIME_ALLOWED_MS plus a margin for everything solr does
+        not count; clients can only ask for a shorter one
+
+        :return: Deadline or None (no limit)
+        """
+        budget = current_app.config.get('SOLR_SERVICE_DEADLINE_MS')
+        time_allowed = current_app.config.get('SOLR_SERVICE_TIME_ALLOWED_MS')
+        if not budget and time_allowed:
+            budget = time_allowed + current_app.config.get('SOLR_SERVICE_DEADLINE_MARGIN_MS', 1000)
+
+        header = current_app.config.get('SOLR_SERVICE_DEADLINE_HEADER', 'X-Request-Deadline-Ms')
+        requested = _safe_int(request.headers.get(header), default=0)
+        if requested > 0:
+            budget = min(budget, requested) if budget else requested
+
+        if budget:
+            return Deadline(budget / 1000.0)
+        return None
+
+    def upstream_timeout(self):
+        """
+        :return: (connect, read) timeout for requests made on behalf of
+            the current request; without a deadline only connecting is limited
+        :raise DeadlineExceeded: if there is no time left
+        """
+        connect = current_app.config.get('SOLR_SERVICE_CONNECT_TIMEOUT', 3.05)
+        if self.deadline is None:
+            return connect, None
+        return self.deadline.timeout(connect=connect)
+
+    def coalesce_timeout(self):
+        timeout = current_app.config.get('SOLR_SERVICE_COALESCE_TIMEOUT', 30)
+        if self.deadline is not None:
+            timeout = min(timeout, self.deadline.remaining())
+        return timeout
+
+    def cache_response(self, cache_key, data, status_code):
+        """
+        Keeps successful responses in `current_app.solr_result_cache`;
+        headers are not stored, the affinity cookie solr sets is only
+        meaningful for the client that triggered the request. Results cut
+        short by timeAllowed are not kept either.
+
+        :param cache_key: string or None (the request must not be cached)
+        :param data: string, response body
+        :param status_code: int
+        """
+        if cache_key is None or status_code != 200 or _partial_results(data):
+            return
+        current_app.solr_result_cache.set(cache_key, data)
 
     def preprocess_request(self, handler: str, query) -> bool:
         should_postprocess_response = False
@@ -151,68 +374,144 @@ class SolrInterface(Resource):
 
         return should_postprocess_response
 
-    def postprocess_response(self, r: requests.Response) -> dict:
-        response_data = r.json()
-        unhighlightable_publishers = current_app.config.get('SOLR_SERVICE_DISALLOWED_HIGHLIGHTS_PUBLISHERS', [])
-        unhighlightable_docs = []
-
-        for doc in response_data['response']['docs']:
-            if 'publisher' not in doc:
-                continue
-
-            if type(doc['publisher']) is list:
-                for publisher in doc['publisher']:
-                    if publisher.lower() in unhighlightable_publishers:
-                        unhighlightable_docs.append(doc['id'])
-                        break
-            else:
-                if doc['publisher'].lower() in unhighlightable_publishers:
-                    unhighlightable_docs.append(doc['id'])
-
-        for remove_doc in unhighlightable_docs:
-            if remove_doc in response_data['highlighting']:
-                doc_highlights = response_data['highlighting'][remove_doc]
-
-                for remove_key in ['body', 'ack']:
-                    if remove_key in doc_highlights:
-                        del doc_highlights[remove_key]
+    def postprocess_response(self, r: requests.Response) -> bytes:
+        return highlight.rewrite(
+            r.content,
+            current_app.config.get('SOLR_SERVICE_MAX_FRAGSIZE', 200),
+            frozenset(current_app.config.get('SOLR_SERVICE_DISALLOWED_HIGHLIGHTS_PUBLISHERS', [])),
+            _json_codec(),
+        )
 
-        max_frag = current_app.config.get('SOLR_SERVICE_MAX_FRAGSIZE', 200)
-        for doc_id in list(response_data['highlighting'].keys()):
-            current_highlights = response_data['highlighting'][doc_id]
-            new_highlights = dict()
+    def apply_highlight_window(self, highlight_text: str, max_len: int) -> List[str]:
+        return highlight.window(highlight_text, max_len)
 
-            for field in current_highlights.keys():
-                new_highlights[field] = [
-                    windowed_highlight
-                    for highlight in current_highlights[field]
-                    for windowed_highlight in self.apply_highlight_window(highlight, max_frag)
-                ]
+    def post_to_solr(self, url, **kwargs):
+        """
+        Sends the request to solr; requests that already carry the affinity
+        cookie(s) re-use a keep-alive connection to their solr instance,
+        the others open a new one so that the ingress can assign the route.
+        When several solr instances serve the url, one of them is picked by
+        `current_app.solr_router`, and another one is tried when it cannot
+        be reached. The outcome is reported to the circuit breaker of the
+        url.
+
+        :param url: string, solr handler url
+        :param kwargs: passed on to requests
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.upstream_timeout())
+        gzip_uploads = current_app.config.get('SOLR_SERVICE_GZIP_UPLOADS', False)
+        if kwargs.get('files') and (gzip_uploads or current_app.config.get('SOLR_SERVICE_STREAM_UPLOADS', False)):
+            spool_size = current_app.config.get('SOLR_SERVICE_SPOOL_BYTES', 1024 * 1024)
+            body = MultipartEncoder(kwargs.pop('files'), spool_size=spool_size)
+            headers = dict(kwargs.get('headers') or {}, **{'Content-Type': body.content_type})
+            if gzip_uploads:
+                body = gzip_spool(body, spool_size, level=current_app.config.get('SOLR_SERVICE_GZIP_LEVEL', 5))
+                headers['Content-Encoding'] = 'gzip'
+            kwargs['data'] = body
+            kwargs['headers'] = headers
+        cookies = kwargs.get('cookies')
+        router = getattr(current_app, 'solr_router', None)
+        if router is None:
+            return self._send(url, cookies, kwargs)
+
+        # bodies read from a stream cannot be sent a second time
+        replayable = not kwargs.get('files') and not hasattr(kwargs.get('data'), 'read')
+        tried = set()
+        while True:
+            routed = router.route(url, cookies, exclude=tried)
+            tried.add(routed)
+            attempt = kwargs
+            if 'Host' in (kwargs.get('headers') or {}):
+                # set by cleanup_solr_request for the configured url
+                attempt = dict(kwargs, headers=dict(kwargs['headers'], Host=urlsplit(routed).netloc))
+            try:
+                r = self._send(routed, cookies, attempt, router)
+            except requests.ConnectionError as e:
+                router.record(routed, False)
+                if isinstance(e, requests.Timeout) or not replayable or \
+                        router.route(url, cookies, exclude=tried) is None:
+                    raise
+                current_app.logger.warning("Solr instance '{}' failed ({}), trying another one".format(routed, e))
+                continue
+            router.record(routed, r.status_code < 500)
+            return r
 
-            response_data['highlighting'][doc_id] = new_highlights
-        
-        for _, doc_highlights in response_data['highlighting'].items():
-            for field, highlights in list(doc_highlights.items()):
-                doc_highlights[field] = [highlight for highlight in highlights
-                                         if highlight is not None and str(highlight).strip() != ""]
+    def _send(self, url, cookies, kwargs, router=None):
+        """
+        :param url: string, url of the solr instance
+        :param cookies: dict or None, affinity cookies
+        :param kwargs: passed on to requests
+        :param router: upstream.Router that picked the instance, or None
+        :return: requests.Response
+        """
+        sessions = getattr(current_app, 'solr_sessions', None)
+        if cookies and sessions is not None:
+            send = sessions.get(url, cookies).post
+        else:
+            send = requests.post
+        if router is not None:
+            send = _remembering_routes(router, send)
 
-        response_data['filtered'] = 'true'
+        breakers = getattr(current_app, 'solr_breakers', None)
+        if breakers is None:
+            return send(url, **kwargs)
 
-        return response_data
+        breaker = breakers.get(url)
+        probe = breaker.allow()
+        start = time.monotonic()
+        try:
+            r = send(url, **kwargs)
+        except requests.RequestException:
+            breaker.record(False, time.monotonic() - start, probe)
+            raise
+        except BaseException:
+            breaker.release(probe)
+            raise
+        breaker.record(r.status_code < 500, time.monotonic() - start, probe)
+        return r
+
+    def stream_response(self, r, decode_content=True):
+        """
+        Relays the body of a solr response (requested with stream=True)
+        chunk by chunk, so the first bytes reach the client before solr
+        has finished sending the rest and the worker never holds the
+        whole page in memory
+
+        :param r: requests.Response obtained with stream=True
+        :kwarg decode_content: bool, if False, the body is relayed in the
+            content-encoding negotiated with solr on behalf of the client
+        :return: tuple - (generator of chunks, status code, cleaned headers)
+        """
+        chunk_size = current_app.config.get('SOLR_SERVICE_STREAM_CHUNK_SIZE', 64 * 1024)
+        if decode_content:
+            chunks = r.iter_content(chunk_size=chunk_size)
+        else:
+            chunks = r.raw.stream(chunk_size, decode_content=False)
 
-    def apply_highlight_window(self, highlight_text: str, max_len: int) -> List[str]:
-        highlight_pattern = re.compile(r'<em>[^>]*</em>', re.IGNORECASE)
-        windowed_snippets = []
+        def generate():
+            try:
+                for chunk in chunks:
+                    if chunk:
+                        yield chunk
+            finally:
+                r.close()
 
-        for match in re.finditer(highlight_pattern, highlight_text):
-            start, end = match.span()
-            if end - start >= max_len:
-                continue
+        return generate(), r.status_code, _clean_headers(r, decoded=decode_content)
 
-            diff = (max_len - (end - start))//2
-            windowed_snippets.append(highlight_text[max(0, start-diff):end+diff-min(0, start-diff)])
+    def encoded_response(self, r):
+        """
+        Reads the body of a solr response (requested with stream=True)
+        without decompressing it, so it can be sent to the client as is
 
-        return windowed_snippets
+        :param r: requests.Response obtained with stream=True
+        :return: tuple - (bytes, status code, cleaned headers)
+        """
+        try:
+            data = r.raw.read(decode_content=False)
+        finally:
+            r.close()
+        return data, r.status_code, _clean_headers(r, decoded=False)
 
     @staticmethod
     def set_cookies(request):
@@ -234,7 +533,7 @@ class SolrInterface(Resource):
         else:
             return None
 
-    def apply_protective_filters(self, payload, user_id, protected_fields, key):
+    def apply_protective_filters(self, payload, user_id, protected_fields, key, limits=None):
         """
         Adds filters to the query that should limit results to conditions
         that are associted with the user_id+protected_field. If a field is
@@ -246,6 +545,8 @@ class SolrInterface(Resource):
         :param key: string, name of the field we are currently processing
             (typically 'fl', but could be 'anything.fl' when dealing
             with subrequests)
+        :param limits: (field, filter) pairs of the user, as returned by
+            user_limits; looked up when not given
         """
         fl = payload.get(key, 'id')
         if key == 'fl':
@@ -262,13 +563,36 @@ class SolrInterface(Resource):
 
         payload[fq_key] = fq
 
-        with current_app.session_scope() as session:
-            for f in session.query(Limits).filter(Limits.uid==user_id, or_(Limits.field==x for x in protected_fields)).all():
-                if f.filter:
-                    fl = u'{0},{1}'.format(fl, f.field)
-                    fq.append(str(f.filter))
-                    payload['fl'] = fl
-            session.commit()
+        if limits is None:
+            limits = self.user_limits(user_id, protected_fields)
+
+        for field, fltr in limits:
+            if field in protected_fields and fltr:
+                fl = u'{0},{1}'.format(fl, field)
+                fq.append(str(fltr))
+                payload[key] = fl
+
+    def user_limits(self, user_id, fields=None):
+        """
+        Rows of the limits table for the user; cached (including the
+        absence of rows) when the app has a limits cache
+
+        :param user_id: string, user id as known to ADS API
+        :param fields: iterable of strings, the protected fields that are
+            needed; without a cache only their rows are fetched
+        :return: tuple of (field, filter) pairs
+        """
+        cache = getattr(current_app, 'solr_limits_cache', None)
+        limits = cache.get(user_id) if cache is not None else None
+        if limits is None:
+            with current_app.session_scope() as session:
+                query = session.query(Limits).filter(Limits.uid==user_id)
+                if cache is None and fields is not None:
+                    query = query.filter(Limits.field.in_(list(fields)))
+                limits = tuple((f.field, f.filter) for f in query.order_by(Limits.id))
+            if cache is not None:
+                cache.set(user_id, limits)
+        return limits
 
     def cleanup_solr_request(self, payload, user_id=None, handler_class="default"):
         """
@@ -326,6 +650,16 @@ class SolrInterface(Resource):
         # - This value is only checked at the time of: Query Expansion, and Document collection
         if 'cursorMark' not in payload:
             time_allowed = current_app.config.get('SOLR_SERVICE_TIME_ALLOWED_MS')
+            if self.deadline is not None:
+                # leave some of the budget for everything after the search itself,
+                # at most a quarter of it so that short deadlines still get results
+                margin = min(current_app.config.get('SOLR_SERVICE_DEADLINE_MARGIN_MS', 1000),
+                             int(self.deadline.seconds * 1000) // 4)
+                left = int(self.deadline.remaining() * 1000) - margin
+                if left <= 0:
+                    raise DeadlineExceeded('No time left for the search within the deadline of {:.3f}s'.format(
+                        self.deadline.seconds))
+                time_allowed = min(time_allowed, left) if time_allowed else left
             if time_allowed:
                 payload['timeAllowed'] = time_allowed
 
@@ -338,27 +672,29 @@ class SolrInterface(Resource):
             if 'hl.maxHighlightCharacters' not in payload:
                 payload['hl.maxHighlightCharacters'] = max_frag
 
+        rules = _sanitization_rules()
+        protected = {} # fl-like key -> protected fields it asked for
         for k,v in list(payload.items()):
-            if 'hl.' in k:
-                if '.snippets' in k:
+            for action, allowed in rules.actions(k):
+                if action == SNIPPETS:
                     payload[k] = max(0, min(_safe_int(v, default=max_hl), max_hl))
-                elif '.fragsize' in k:
+                elif action == FRAGSIZE:
                     payload[k] = max(1, min(_safe_int(v, default=max_frag), max_frag)) #0 would return whole field
                     payload['hl.maxHighlightCharacters'] = payload[k]
-            if k == 'hl.fl':
-                self._cleanup_fields(payload, k, current_app.config.get('SOLR_SERVICE_ALLOWED_HIGHLIGHTS_FIELDS'))
-            if k == 'fl' or ('.fl' in k and k != 'hl.fl'):
-                self._cleanup_fl(payload, user_id, k)
-            if k == 'rows' or '.rows' in k:
-                self._cleanup_rows(payload, user_id, k)
-            if k == 'facet.field':
-                self._cleanup_fields(payload, k, current_app.config.get('SOLR_SERVICE_ALLOWED_FACET_FIELDS'))
-            if k == 'facet.pivot':
-                self._cleanup_fields(payload, k, current_app.config.get('SOLR_SERVICE_ALLOWED_FACET_PIVOT'))
-            if k == 'stats.field':
-                self._cleanup_fields(payload, k, current_app.config.get('SOLR_SERVICE_ALLOWED_STATS_FIELDS'))
-            if k == 'sort':
-                self._cleanup_fields(payload, k, current_app.config.get('SOLR_SERVICE_ALLOWED_SORT_FIELDS'))
+                elif action == FIELDS:
+                    self._cleanup_fields(payload, k, allowed)
+                elif action == FL:
+                    fields = self._cleanup_fl(payload, user_id, k)
+                    if fields:
+                        protected[k] = fields
+                elif action == ROWS:
+                    self._cleanup_rows(payload, user_id, k)
+
+        if protected:
+            # one lookup for the main request and all its subrequests
+            limits = self.user_limits(user_id, set(f for fields in protected.values() for f in fields))
+            for k, fields in protected.items():
+                self.apply_protective_filters(payload, user_id, fields, k, limits=limits)
 
         return payload, headers
 
@@ -386,7 +722,12 @@ class SolrInterface(Resource):
         payload[key] = min(_safe_int(value, default=default_rows), max_rows)
 
     def _cleanup_fl(self, payload, user_id, key):
+        """
+        Removes disallowed fields from the field list
 
+        :return: list of the protected fields that were asked for (they
+            are only returned together with their protective filters)
+        """
         values = payload[key]
 
         if not isinstance(values, list):
@@ -396,9 +737,8 @@ class SolrInterface(Resource):
         for y in values:
             fields.extend([i.strip().lower() for i in y.split(',')])
 
-        disallowed = current_app.config.get(
-            'SOLR_SERVICE_DISALLOWED_FIELDS'
-        )
+        rules = _sanitization_rules()
+        disallowed = rules.disallowed_fields
 
         protected_fields = []
         if disallowed:
@@ -412,12 +752,10 @@ class SolrInterface(Resource):
             fields.pop(fields.index('*'))
 
         if len(fields) == 0:
-            fields = current_app.config.get('SOLR_SERVICE_ALLOWED_FIELDS')
+            fields = list(rules.allowed_fields)
 
         payload[key] = ','.join(fields)
-
-        if len(protected_fields) > 0:
-            self.apply_protective_filters(payload, user_id, protected_fields, key)
+        return protected_fields
 
 
     def get_host(self, url):
@@ -468,7 +806,8 @@ class SolrInterface(Resource):
         # this is only accepted if the data was passed in request.data
         # if user tried to send the data with anonymous request.fiel stream
         # they must set the appropriate headers
-        if request.data and isinstance(request.data, basestring) and len(request.data) > 0:
+        body = _request_body(request)
+        if body is not None:
             if 'fq' not in params:
                 params['fq'] = [u'{!bitset}']
             elif isinstance(params['fq'], str) and '{!bitset}' not in params['fq']:
@@ -478,7 +817,7 @@ class SolrInterface(Resource):
 
             # we'll package request.data into files
             streams.add('old-bad-behaviour')
-            params['old-bad-behaviour'] = request.data
+            params['old-bad-behaviour'] = body
 
 
         # what is left is missing and we need to fill in the gaps
@@ -490,6 +829,53 @@ class SolrInterface(Resource):
 
         return files
 
+    def inline_bigquery(self, params, headers, files):
+        """
+        A bigquery of at most SOLR_SERVICE_INLINE_BIGQUERY_MAX_DOCS
+        bibcodes is turned into a {!terms f=bibcode} filter, so that solr
+        answers it with its regular search handler (and filter cache)
+        instead of the multipart bigquery handler. Only done when the
+        result is the same: a single csv stream of bibcodes that is used
+        either as the `{!bitset}` fq, or as a whole `docs(name)` q/fq.
+
+        :param params: dict, sanitized request; modified in place when
+            the stream is inlined
+        :param headers: dict, headers for solr
+        :param files: dict, as returned by check_for_embedded_bigquery
+        :return: dict, the files still to be uploaded
+        """
+        max_docs = current_app.config.get('SOLR_SERVICE_INLINE_BIGQUERY_MAX_DOCS', 0)
+        if not files or len(files) != 1 or max_docs <= 0:
+            return files
+
+        name, stream = list(files.items())[0]
+        if len(stream) < 3 or stream[2] != 'big-query/csv':
+            return files
+
+        # every parameter value that refers to the stream
+        bitset = [(k, i) for k, i, v in _param_values(params) if k == 'fq' and v.strip() == u'{!bitset}']
+        docs = [(k, i, v) for k, i, v in _param_values(params) if 'docs(' in v]
+        if bitset and not docs and len(bitset) == 1:
+            target = bitset[0]
+        elif docs and not bitset and len(docs) == 1 and docs[0][0] in ('q', 'fq') and \
+                docs[0][2].strip() == u'docs({})'.format(name):
+            target = docs[0][:2]
+        else:
+            return files
+
+        bibcodes = _small_bibcode_list(stream[1], max_docs)
+        if bibcodes is None:
+            return files
+
+        key, i = target
+        value = u'{!terms f=bibcode}' + u','.join(bibcodes)
+        if i is None:
+            params[key] = value
+        else:
+            params[key][i] = value
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return {}
+
     def _get_stream_data(self, params, streams, request, handler_class="default"):
         # TODO: it seems natural that this functionality could live inside
         # myads; there we'd be not forced to query a remote service; however
@@ -504,7 +890,10 @@ class SolrInterface(Resource):
                 x = params[sn]
                 if isinstance(x, list) and len(x) > 0:
                     x = x[0]
-                out[sn] = (sn, x, 'big-query/csv')
+                ctype = 'big-query/csv'
+                if sn == 'old-bad-behaviour' and 'big-query' in request.mimetype:
+                    ctype = request.mimetype # e.g. a binary big-query/bitset body
+                out[sn] = (sn, x, ctype)
                 streams.remove(sn)
                 del params[sn]
             elif request.data and not isinstance(request.data, basestring) and sn in request.data: # if data is a dict...
@@ -514,12 +903,19 @@ class SolrInterface(Resource):
                 out[sn] = (sn, x, 'big-query/csv')
                 streams.remove(sn)
             elif request.files and sn in request.files:
-                f = request.files[sn]
-                out[sn] = (f.name, f.stream, f.mimetype)
+                out[sn] = _uploaded_file(request.files[sn])
                 streams.remove(sn)
 
 
+        uploaded = list(out)
+        store = getattr(current_app, 'solr_bigquery_store', None)
+
+        calls = []
+        names = []
         for s in streams:
+            if s.startswith(_SHA_PREFIX):
+                out[s] = self._get_stored_bigquery(store, s)
+                continue
             if '/' in s:
                 prefix, value = s.split('/', 1)
             else:
@@ -536,42 +932,171 @@ class SolrInterface(Resource):
                 if internal_param in request.headers:
                     new_headers[internal_param] = request.headers[internal_param]
 
-            docs = None
-
             if prefix == 'library':
-                q = self._harvest_library(value, new_headers)
-                docs = 'bibcode\n' + '\n'.join(q['documents'])
+                calls.append((self._get_library, value, new_headers))
 
             else:
-                r = current_app.client.get(current_app.config['VAULT_ENDPOINT'] + '/' + value,
-                                           headers=new_headers)
-                r.raise_for_status()
-
-                # json serialized dictionary with two keys, 'query' and 'bigquery'
-                # their values are strings (for query urlencoded parameters)
-                q = json.loads(r.json()['query'])
-                try:
-                    params = parse_qs(q['query'])
-                except:
-                    params = {}
-
-                if value in params: # it is encoded in parameters
-                    docs = params[value]
-                    if isinstance(docs, list): # urlparsing can do that
-                        docs = docs[0]
-                elif 'bigquery' in q and q['bigquery']: # this query has a bigquery, so it must be that
-                    docs = q['bigquery']
-                else:
-                    raise Exception('Query relies on {} however such queryid is not available via API'.format(s))
+                calls.append((self._get_vault_query, value, new_headers))
+            names.append(s)
 
+        # the streams are independent of each other, they are resolved
+        # concurrently
+        workers = current_app.config.get('SOLR_SERVICE_DOCS_WORKERS', 4)
+        for s, docs in zip(names, _run_concurrently(calls, workers)):
             out[s] = (s, docs, "big-query/csv")
 
         # copy over remaining files
         for k,v in request.files.items():
             if k not in out:
-                out[k] = (v.name, v.stream, v.mimetype)
+                out[k] = _uploaded_file(v)
+                uploaded.append(k)
+
+        # what was uploaded with this request can be referenced by its hash later
+        if store is not None and uploaded:
+            self._announce_bigquery_hashes([self._store_bigquery(store, *out[k]) for k in uploaded])
         return out
 
+    def _store_bigquery(self, store, name, data, ctype):
+        """
+        Keeps an uploaded bigquery in the local store, addressed by the
+        sha256 of its content (and content type)
+
+        :return: string, 'sha:<hex>' (usable as docs(sha:<hex>)), or None
+            if the upload is too large to be kept
+        """
+        max_bytes = current_app.config.get('SOLR_SERVICE_BIGQUERY_STORE_MAX_ITEM_BYTES', 16 * 1024 * 1024)
+        header = ctype.encode('utf8') + b'\n'
+        if not hasattr(data, 'read'):
+            body = data.encode('utf8') if isinstance(data, str) else data
+            if len(body) > max_bytes:
+                return None
+            value = header + body
+            key = _SHA_PREFIX + hashlib.sha256(value).hexdigest()
+            if store.get(key) is None:
+                store.set(key, value)
+            return key
+
+        position = data.tell()
+        data.seek(0, os.SEEK_END)
+        too_large = data.tell() - position > max_bytes
+        data.seek(position)
+        if too_large:
+            return None
+        # the upload may be spooled to disk: it is hashed and copied a chunk
+        # at a time, so that only the stored copy is held in memory
+        chunk_size = current_app.config.get('SOLR_SERVICE_STREAM_CHUNK_SIZE', 64 * 1024)
+        digest = hashlib.sha256(header)
+        value = BytesIO()
+        value.write(header)
+        try:
+            while True:
+                chunk = data.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                value.write(chunk)
+        finally:
+            # the same file is sent to solr afterwards
+            data.seek(position)
+        key = _SHA_PREFIX + digest.hexdigest()
+        if store.get(key) is None:
+            store.set(key, value.getvalue())
+        return key
+
+    def _get_stored_bigquery(self, store, key):
+        """
+        :param key: string, 'sha:<hex>' as returned with an earlier upload
+        :return: tuple - (name, data, content type) for the solr request
+        :raise NotFound: the content is not (or no longer) in the store;
+            the client has to upload it again
+        """
+        value = store.get(key) if store is not None else None
+        if value is None:
+            raise NotFound('Unknown bigquery {}, it has to be uploaded again'.format(key))
+        ctype, body = value.split(b'\n', 1)
+        return (key, body, ctype.decode('utf8'))
+
+    def _announce_bigquery_hashes(self, hashes):
+        """Sends the hashes of the uploaded bigqueries back to the client"""
+        hashes = [h for h in hashes if h]
+        if not hashes:
+            return
+        header = current_app.config.get('SOLR_SERVICE_BIGQUERY_HASH_HEADER', 'X-Bigquery-Sha')
+
+        @after_this_request
+        def add_header(response):
+            response.headers[header] = ', '.join(hashes)
+            return response
+
+    def _get_vault_query(self, qid, headers):
+        """
+        Retrieves the documents stored in vault under the qid; stored
+        queries are immutable, so the result is cached when the app
+        has a vault cache
+
+        :return: string, the bigquery payload
+        """
+        cache = getattr(current_app, 'solr_vault_cache', None)
+        if cache is not None:
+            docs = cache.get(qid)
+            if docs is not None:
+                return docs.decode('utf8')
+
+        r = current_app.client.get(current_app.config['VAULT_ENDPOINT'] + '/' + qid,
+                                   headers=headers,
+                                   timeout=self.upstream_timeout())
+        r.raise_for_status()
+
+        # json serialized dictionary with two keys, 'query' and 'bigquery'
+        # their values are strings (for query urlencoded parameters)
+        q = json.loads(r.json()['query'])
+        try:
+            params = parse_qs(q['query'])
+        except:
+            params = {}
+
+        if qid in params: # it is encoded in parameters
+            docs = params[qid]
+            if isinstance(docs, list): # urlparsing can do that
+                docs = docs[0]
+        elif 'bigquery' in q and q['bigquery']: # this query has a bigquery, so it must be that
+            docs = q['bigquery']
+        else:
+            raise Exception('Query relies on {} however such queryid is not available via API'.format(qid))
+
+        if cache is not None:
+            cache.set(qid, docs.encode('utf8'))
+        return docs
+
+    def _get_library(self, library_id, headers):
+        """
+        Retrieves the bibcodes of the library; when the app has a library
+        cache, a cached harvest is reused as long as biblib reports the
+        library unchanged (checked with a single one-row page, which
+        also verifies that the user may still read the library)
+
+        :return: string, the bigquery payload
+        """
+        cache = getattr(current_app, 'solr_library_cache', None)
+        cached = cache.get(library_id) if cache is not None else None
+        if cached is not None:
+            version, docs = cached
+            r = current_app.client.get(current_app.config['LIBRARY_ENDPOINT'] + '/' + library_id,
+                                       params={'rows': 1, 'start': 0},
+                                       headers=headers,
+                                       timeout=self.upstream_timeout())
+            r.raise_for_status()
+            if _library_version(r.json()['metadata']) == version:
+                return docs.decode('utf8')
+
+        q = self._harvest_library(library_id, headers)
+        docs = 'bibcode\n' + '\n'.join(sorted(q['documents']))
+        if cache is not None and len(q['versions']) == 1 and None not in q['versions']:
+            # the library did not change while it was being harvested
+            encoded = docs.encode('utf8')
+            cache.set(library_id, (q['versions'].pop(), encoded), size=len(encoded))
+        return docs
+
     def _harvest_library(self, library_id, headers):
         """I looked inside the impl of the biblib/libraries
         and unfortunately it is quite expensive; not only does
@@ -583,29 +1108,39 @@ class SolrInterface(Resource):
 
 
         maxr = current_app.config.get('BIBLIB_MAX_ROWS', 2000)
-        params = {'rows': maxr, 'start': 0}
-        out = {'documents': set(), 'library': library_id}
-        while True:
-            r = current_app.client.get(current_app.config['LIBRARY_ENDPOINT'] + '/' + library_id,
-                                       params=params,
-                                       headers=headers)
+        workers = current_app.config.get('SOLR_SERVICE_LIBRARY_WORKERS', 4)
+        url = current_app.config['LIBRARY_ENDPOINT'] + '/' + library_id
+        client = current_app.client # the workers have no app context
+
+        def fetch(start, timeout):
+            r = client.get(url,
+                           params={'rows': maxr, 'start': start},
+                           headers=headers,
+                           timeout=timeout)
             r.raise_for_status()
+            return r.json()
 
-            q = r.json()
-            oldcount = len(out['documents'])
-            out['documents'].update(q['documents'])
-            out['metadata'] = q['metadata']
-
-            # all of these conditions because biblib doesn't guarantee stable sort order, sigh...
-            if 'num_documents' in out['metadata'] and out['metadata']['num_documents'] <= len(out['documents']) or \
-                len(q['documents']) < maxr or \
-                oldcount == len(out['documents']) or \
-                len(q['documents']) == 0:
-                break
-
-            params['start'] = params['start'] + maxr
-
-        return out
+        out = {'documents': set(), 'library': library_id, 'versions': set()}
+        start = 0
+        while True:
+            # once the first page told us the size of the library, the
+            # remaining pages are requested all at once
+            num_documents = out.get('metadata', {}).get('num_documents') or 0
+            starts = list(range(start, num_documents, maxr)) or [start]
+            for q in _fetch_pages(fetch, starts, self.upstream_timeout(), workers):
+                oldcount = len(out['documents'])
+                out['documents'].update(q['documents'])
+                out['metadata'] = q['metadata']
+                out['versions'].add(_library_version(q['metadata']))
+
+                # all of these conditions because biblib doesn't guarantee stable sort order, sigh...
+                if 'num_documents' in out['metadata'] and out['metadata']['num_documents'] <= len(out['documents']) or \
+                    len(q['documents']) < maxr or \
+                    oldcount == len(out['documents']) or \
+                    len(q['documents']) == 0:
+                    return out
+
+            start = starts[-1] + maxr
 
 
 class Tvrh(SolrInterface):
@@ -659,7 +1194,10 @@ class BigQuery(SolrInterface):
                'bot': 'BOT_SOLR_SERVICE_BIGQUERY_HANDLER',
                'bot_embedded_bigquery': 'BOT_SOLR_SERVICE_BIGQUERY_HANDLER',
                'anonymous': 'ANONYMOUS_SOLR_SERVICE_BIGQUERY_HANDLER',
-               'anonymous_embedded_bigquery': 'ANONYMOUS_SOLR_SERVICE_BIGQUERY_HANDLER'}
+               'anonymous_embedded_bigquery': 'ANONYMOUS_SOLR_SERVICE_BIGQUERY_HANDLER',
+               'default_inlined_bigquery': 'SOLR_SERVICE_SEARCH_HANDLER',
+               'bot_inlined_bigquery': 'BOT_SOLR_SERVICE_SEARCH_HANDLER',
+               'anonymous_inlined_bigquery': 'ANONYMOUS_SOLR_SERVICE_SEARCH_HANDLER'}
 
     def get_handler_class(self):
         """Identify bot requests based on their authentication token"""
@@ -676,7 +1214,10 @@ class BigQuery(SolrInterface):
             return "default"
 
     def post(self):
+        self.deadline = self.request_deadline()
         handler_class = self.get_handler_class()
+        stream = current_app.config.get('SOLR_SERVICE_STREAM_RESPONSES', False)
+        encoded = current_app.config.get('SOLR_SERVICE_COMPRESSION', False)
         payload = request.form.to_dict(flat=False)
         payload.update(request.args.to_dict(flat=False))
         if request.is_json:
@@ -686,25 +1227,329 @@ class BigQuery(SolrInterface):
         files = self.check_for_embedded_bigquery(query, request, headers, handler_class=handler_class)
 
         if files and len(files) > 0:
+            files = self.inline_bigquery(query, headers, files)
+            if not files: # small enough for the regular search handler
+                handler_class += '_inlined_bigquery'
             try:
                 current_user_id = current_user.get_id()
             except:
                 # If solr service is not shipped with adsws, this will fail and it is ok
                 current_user_id = request.headers.get("X-api-uid", None)
             current_app.logger.info("Dispatching 'POST' request to endpoint '{}' for user '{}'".format(current_app.config[self.handler[handler_class]], current_user_id or "anonymous"))
-            r = requests.post(
-                current_app.config[self.handler[handler_class]],
-                params=query,
-                headers=headers,
-                files=files,
-                cookies=SolrInterface.set_cookies(request),
-            )
+            if encoded:
+                headers['Accept-Encoding'] = request.headers.get('Accept-Encoding', 'identity')
+            if files:
+                r = self.post_to_solr(
+                    current_app.config[self.handler[handler_class]],
+                    params=query,
+                    headers=headers,
+                    files=files,
+                    cookies=SolrInterface.set_cookies(request),
+                    stream=stream or encoded,
+                )
+            else:
+                r = self.post_to_solr(
+                    current_app.config[self.handler[handler_class]],
+                    data=query,
+                    headers=headers,
+                    cookies=SolrInterface.set_cookies(request),
+                    stream=stream or encoded,
+                )
             current_app.logger.info("Received response from endpoint '{}' with status code '{}'".format(current_app.config[self.handler[handler_class]], r.status_code))
         else:
             message = "Malformed request"
             current_app.logger.error(message)
             return json.dumps({'error': message}), 400
-        return r.text, r.status_code, r.headers
+        if stream:
+            return self.stream_response(r, decode_content=not encoded)
+        if encoded:
+            return self.encoded_response(r)
+        return r.content, r.status_code, _clean_headers(r)
+
+
+# streams resolved from the local bigquery store, e.g. docs(sha:<hex>)
+_SHA_PREFIX = 'sha:'
+
+
+# Headers of the solr response that are relayed to the client; the rest
+# either only applies to the connection with solr (RFC 7230, section 6.1),
+# describes a body we rewrite, or is set by us (see create_app)
+_RELAYED_HEADERS = frozenset(['set-cookie', 'retry-after'])
+
+
+def _clean_headers(r, decoded=True):
+    """
+    Picks the upstream headers that are relayed to the client
+
+    :param r: requests.Response
+    :kwarg decoded: bool, the body has been decompressed by requests, so
+        the content-encoding announced by solr no longer applies
+    :return: werkzeug Headers; one entry per cookie set by solr, which
+        requests would have folded into a single comma separated value
+    """
+    raw = getattr(r.raw, 'headers', None)
+    if isinstance(raw, Mapping) and hasattr(raw, 'getlist'):
+        # urllib3 keeps every value of a repeated header
+        items = ((k, v) for k in raw for v in raw.getlist(k))
+    else:
+        items = r.headers.items()
+    headers = Headers()
+    for k, v in items:
+        name = k.lower()
+        if name in _RELAYED_HEADERS or (name == 'content-encoding' and not decoded):
+            headers.add(k, v)
+    return headers
+
+
+def _param_values(params):
+    """
+    :return: generator of (key, index in the list of values or None,
+        value) for every string value of the request parameters
+    """
+    for k, v in params.items():
+        if isinstance(v, basestring):
+            yield k, None, v
+        elif isinstance(v, list):
+            for i, x in enumerate(v):
+                if isinstance(x, basestring):
+                    yield k, i, x
+
+
+def _small_bibcode_list(data, max_docs):
+    """
+    Parses a big-query/csv stream of bibcodes, as long as it is small
+
+    :param data: string, bytes or a seekable file-like (left at its
+        original position)
+    :param max_docs: int, largest number of bibcodes accepted
+    :return: list of unique bibcodes, or None if the stream is too large
+        or not a plain list of bibcodes
+    """
+    limit = (max_docs + 1) * 64 # bibcodes are 19 characters
+    if hasattr(data, 'read'):
+        try:
+            position = data.tell()
+        except (AttributeError, IOError, OSError):
+            return None
+        raw = data.read(limit + 1)
+        data.seek(position)
+    else:
+        raw = data
+    if len(raw) > limit:
+        return None
+    if isinstance(raw, bytes):
+        try:
+            raw = raw.decode('utf8')
+        except UnicodeDecodeError:
+            return None
+
+    lines = [x.strip() for x in raw.splitlines() if x.strip()]
+    if len(lines) < 2 or lines[0] != u'bibcode':
+        return None
+    bibcodes = []
+    seen = set()
+    for x in lines[1:]:
+        if ',' in x or ' ' in x or '\t' in x:
+            return None
+        if x not in seen:
+            seen.add(x)
+            bibcodes.append(x)
+    if len(bibcodes) > max_docs:
+        return None
+    return bibcodes
+
+
+def _uploaded_file(f):
+    """
+    :param f: werkzeug FileStorage from request.files
+    :return: tuple - (name, stream, mimetype) as accepted by requests;
+        parts sent with `Content-Encoding: gzip` are inflated into a
+        spooled temporary file
+    """
+    stream = f.stream
+    if f.headers.get('Content-Encoding', '').strip().lower() in ('gzip', 'x-gzip'):
+        config = current_app.config
+        stream = spool(GzipInput(stream, config.get('SOLR_SERVICE_MAX_DECOMPRESSED_BYTES', 256 * 1024 * 1024)),
+                       config.get('SOLR_SERVICE_SPOOL_BYTES', 1024 * 1024)) or BytesIO()
+    return (f.name, stream, f.mimetype)
+
+
+def _request_body(request):
+    """
+    The raw body of a request that werkzeug does not parse as a form
+    (for forms, werkzeug already spools the uploaded files); it is read
+    chunk by chunk and spilled to a temporary file when it is larger
+    than SOLR_SERVICE_SPOOL_BYTES
+
+    :return: file-like, or None if the request has no such body
+    """
+    if request.mimetype in FORM_MIMETYPES:
+        return None
+    if request.is_json: # already loaded by the view
+        data = request.get_data()
+        return BytesIO(data) if data else None
+    return spool(request.stream, current_app.config.get('SOLR_SERVICE_SPOOL_BYTES', 1024 * 1024))
+
+
+def _library_version(metadata):
+    """
+    :param metadata: dict, library metadata as returned by biblib
+    :return: tuple identifying the content of the library, or None if
+        the metadata cannot tell
+    """
+    if metadata.get('date_last_modified') is None or metadata.get('num_documents') is None:
+        return None
+    return metadata['num_documents'], metadata['date_last_modified']
+
+
+def _run_concurrently(calls, workers):
+    """
+    Runs the calls within the app context of up to `workers` threads;
+    when one of them fails, the calls not started yet are cancelled and
+    its error is raised
+
+    :param calls: list of tuples - (function, *args)
+    :return: list, results in the order of the calls
+    """
+    if len(calls) <= 1 or workers <= 1:
+        return [c[0](*c[1:]) for c in calls]
+
+    app = current_app._get_current_object()
+
+    def run(fn, *args):
+        with app.app_context():
+            return fn(*args)
+
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(calls)))
+    futures = [executor.submit(run, *c) for c in calls]
+    try:
+        return [f.result() for f in futures]
+    finally:
+        for f in futures:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+def _fetch_pages(fetch, starts, timeout, workers):
+    """
+    Yields fetch(start, timeout) for every start, in order; several
+    pages are fetched concurrently by up to `workers` threads. Pages
+    that were not consumed yet are cancelled when the caller stops
+    iterating.
+    """
+    if len(starts) == 1 or workers <= 1:
+        for start in starts:
+            yield fetch(start, timeout)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(starts)))
+    futures = [executor.submit(fetch, start, timeout) for start in starts]
+    try:
+        for f in futures:
+            yield f.result()
+    finally:
+        for f in futures:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+def _sanitization_rules():
+    """
+    Rules compiled by create_app; compiled on first use when the views
+    are used by an app that did not set them up (e.g. inside adsws)
+    """
+    rules = getattr(current_app, 'solr_rules', None)
+    if rules is None:
+        rules = current_app.solr_rules = SanitizationRules.from_config(current_app.config)
+    return rules
+
+
+def _json_codec():
+    """
+    Codec selected by create_app; the standard library when the views
+    are used by an app that did not set one up
+    """
+    return getattr(current_app, 'solr_codec', None) or codec.select('json')
+
+
+def _buffered(r):
+    """Reads the whole body, so that the response can be used by several threads"""
+    r.content
+    return r
+
+
+# Parameters that differ between otherwise identical requests. timeAllowed
+# follows the time left before the deadline; the results it cuts short are
+# neither cached nor shared (see _partial_results)
+_VOLATILE_PARAMS = frozenset(['internal_logging_params', 'timeAllowed'])
+
+
+def _canonical_key(handler_class, handler, query):
+    """
+    Digest of a sanitized solr request that does not depend on the
+    order in which the client sent the parameters
+
+    :param handler_class: string, e.g. 'bot'
+    :param handler: string, name of the config key with the solr url
+    :param query: dict, sanitized payload
+    :return: string
+    """
+    items = []
+    for k, v in query.items():
+        if k in _VOLATILE_PARAMS:
+            continue
+        if not isinstance(v, (list, tuple)):
+            v = [v]
+        items.append((k, [str(x) for x in v]))
+    items.sort()
+    return hashlib.sha1(json.dumps([handler_class, handler, items]).encode('utf-8')).hexdigest()
+
+
+def _remembering_routes(router, send):
+    """
+    Wraps `send` so that the route cookies set by solr are recorded along
+    with the instance that answered (see upstream.Router)
+    """
+    def wrapper(url, **kwargs):
+        r = send(url, **kwargs)
+        jar = getattr(r, 'cookies', None)
+        if isinstance(jar, RequestsCookieJar):
+            names = current_app.config.get('SOLR_SERVICE_FORWARDED_COOKIES', {})
+            cookies = {name: jar.get(name) for name in names if jar.get(name)}
+            if cookies:
+                router.remember(url, cookies)
+        return r
+    return wrapper
+
+
+_PARTIAL_RESULTS = re.compile(br'"partialResults"\s*:\s*true')
+
+
+def _partial_results(body):
+    """
+    :param body: bytes, solr response
+    :return: bool, solr flagged the results as incomplete (timeAllowed hit)
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    try:
+        member = first_member(body)
+    except (ValueError, IndexError):
+        return False
+    if not member or member[0] != b'responseHeader':
+        return False
+    return _PARTIAL_RESULTS.search(body, member[1], member[2]) is not None
+
+
+def _coalescing_key(key, cookies):
+    """
+    :param key: string, digest of the request
+    :param cookies: dict or None, affinity cookies forwarded to solr
+    :return: string
+    """
+    if not cookies:
+        return key
+    return key + '|' + '&'.join('{}={}'.format(k, v) for k, v in sorted(cookies.items()))
 
 
 def _safe_int(val, default=0):